@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    A stand in Jolokia agent for benchmarking jmxfuse without a JVM.
+
+    Serves the parts of the Jolokia protocol jmxfuse uses: version, list, search (with
+    ifModifiedSince), read (single, attribute lists, patterns, inner paths and bulk
+    requests), write and exec. The number of mbeans, attributes per mbean, size of string
+    payloads and the latency of each request can be set.
+
+    POST /control with {"register": n} or {"unregister": n} adds or removes mbeans, e.g.
+    to measure rescans.
+
+    @license: GPL
+    @copyright: Alastair McCormack
+    @author: Alastair McCormack
+    @contact: alastair@mcc-net.co.uk
+"""
+
+import re
+import sys
+import json
+import time
+import socket
+import urllib
+import optparse
+import threading
+from fnmatch import fnmatchcase
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+class fake_mbean_server(object):
+    """ The mbeans of the fake agent """
+
+    def __init__(self, mbeans=1000, attributes=10, payload=64, domains=10):
+        self.attributes = attributes
+        self.payload = payload
+        self.domains = domains
+        self.mbeans = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.changed = time.time()
+        # Tells one run of the agent from another, as it does for a JVM
+        self.mbeans["java.lang:type=Runtime"] = {"StartTime": int(self.changed * 1000), "Name": "fakejolokia"}
+        self.register(mbeans)
+
+    def register(self, count):
+        with self.lock:
+            for i in xrange(count):
+                mbean_id = self.next_id
+                self.next_id += 1
+                object_name = "bench.d%d:type=T%d,name=m%d" % (mbean_id % self.domains, mbean_id % 7, mbean_id)
+                values = dict(("Attr%d" % n, mbean_id + n) for n in xrange(self.attributes))
+                values["Payload"] = "x" * self.payload
+                values["Usage"] = {"used": mbean_id, "max": 1000000, "committed": 500000, "init": 1000}
+                self.mbeans[object_name] = values
+            self.changed = time.time()
+
+    def unregister(self, count):
+        with self.lock:
+            for object_name in sorted(self.mbeans)[:count]:
+                del self.mbeans[object_name]
+            self.changed = time.time()
+
+    def get_info(self, object_name):
+        attr = {}
+        for (name, value) in self.mbeans[object_name].items():
+            if isinstance(value, dict):
+                attr_type = "javax.management.openmbean.CompositeData"
+            elif isinstance(value, basestring):
+                attr_type = "java.lang.String"
+            else:
+                attr_type = "long"
+            attr[name] = {"type": attr_type, "rw": name == "Payload", "desc": name}
+        op = {"reset": {"args": [], "ret": "void", "desc": "Reset the counters"},
+              "echo": {"args": [{"name": "text", "type": "java.lang.String", "desc": "Text to return"}],
+                       "ret": "java.lang.String", "desc": "Returns text"}}
+        return {"desc": "A benchmark mbean", "class": "bench.Thing", "attr": attr, "op": op}
+
+    def matches(self, pattern, object_name):
+        """ ObjectName pattern matching, good enough for domain globs and key=value lists ending in * """
+        (pattern_domain, sep, pattern_keys) = pattern.partition(":")
+        (domain, sep, keys) = object_name.partition(":")
+        if not fnmatchcase(domain, pattern_domain):
+            return False
+        properties = dict(key_value.split("=", 1) for key_value in keys.split(","))
+        pattern_properties = [key_value for key_value in pattern_keys.split(",") if key_value != "*"]
+        for key_value in pattern_properties:
+            (key, value) = key_value.split("=", 1)
+            if key not in properties or not fnmatchcase(properties[key], value):
+                return False
+        wildcard = pattern_keys == "*" or pattern_keys.endswith(",*")
+        return wildcard or len(pattern_properties) == len(properties)
+
+def unescape(element):
+    return element.replace("!/", "/").replace("!!", "!")
+
+def split_path(path):
+    return [unescape(element) for element in re.split(r"(?<!!)/", path) if element]
+
+class jolokia_handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer writes, so that the headers and body go out in one segment
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, obj):
+        body = json.dumps(obj)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        (path, sep, query) = self.path.partition("?")
+        config = dict(parameter.split("=", 1) for parameter in query.split("&") if "=" in parameter)
+        path = urllib.unquote(path[len("/jolokia"):].strip("/"))
+        if not path:
+            return self.send_json(self.respond({"type": "version"}))
+
+        (request_type, sep, rest) = path.partition("/")
+        request = {"type": request_type, "config": config}
+        if request_type == "list" and rest:
+            request["path"] = rest
+        elif request_type in ("read", "search"):
+            elements = re.split(r"(?<!!)/", rest, 2)
+            request["mbean"] = unescape(elements[0])
+            if len(elements) > 1:
+                request["attribute"] = unescape(elements[1])
+            if len(elements) > 2:
+                request["path"] = elements[2]
+        self.send_json(self.respond(request))
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        body = json.loads(self.rfile.read(int(self.headers.getheader("content-length"))))
+        if self.path.startswith("/control"):
+            self.server.mbean_server.register(body.get("register", 0))
+            self.server.mbean_server.unregister(body.get("unregister", 0))
+            return self.send_json({"status": 200, "value": len(self.server.mbean_server.mbeans)})
+        if isinstance(body, list):
+            return self.send_json([self.respond(request) for request in body])
+        self.send_json(self.respond(body))
+
+    def respond(self, request):
+        try:
+            response = self.handle_request(request)
+        except KeyError, e:
+            response = {"status": 404, "error": "javax.management.InstanceNotFoundException : %s" % e}
+        response["request"] = request
+        response["timestamp"] = int(time.time())
+        return response
+
+    def handle_request(self, request):
+        mbean_server = self.server.mbean_server
+        mbeans = mbean_server.mbeans
+        request_type = request["type"].lower()
+        config = request.get("config", {})
+
+        if_modified_since = config.get("ifModifiedSince")
+        if if_modified_since and request_type in ("list", "search") and int(mbean_server.changed) < int(if_modified_since):
+            return {"status": 304}
+
+        if request_type == "version":
+            return {"status": 200, "value": {"agent": "fakejolokia", "protocol": "7.2"}}
+
+        if request_type == "search":
+            return {"status": 200, "value": sorted(name for name in mbeans.keys() if mbean_server.matches(request["mbean"], name))}
+
+        if request_type == "list":
+            path = split_path(request.get("path", ""))
+            if len(path) >= 2:
+                value = mbean_server.get_info("%s:%s" % (path[0], path[1]))
+                for element in path[2:]:
+                    value = value[element]
+                return {"status": 200, "value": value}
+            value = {}
+            for object_name in mbeans.keys():
+                (domain, sep, keys) = object_name.partition(":")
+                if str(config.get("maxDepth")) == "2":
+                    value.setdefault(domain, {})[keys] = {}
+                else:
+                    value.setdefault(domain, {})[keys] = mbean_server.get_info(object_name)
+            return {"status": 200, "value": value}
+
+        if request_type == "read":
+            object_name = request["mbean"]
+            attribute = request.get("attribute")
+            if "*" in object_name or "?" in object_name:
+                value = {}
+                for (name, values) in mbeans.items():
+                    if mbean_server.matches(object_name, name):
+                        value[name] = self.select(values, attribute)
+                return {"status": 200, "value": value}
+
+            if attribute is None or isinstance(attribute, list):
+                return {"status": 200, "value": self.select(mbeans[object_name], attribute)}
+            value = mbeans[object_name][attribute]
+            for element in split_path(request.get("path", "")):
+                if isinstance(value, list):
+                    element = int(element)
+                value = value[element]
+            return {"status": 200, "value": value}
+
+        if request_type == "write":
+            mbeans[request["mbean"]][request["attribute"]] = request["value"]
+            return {"status": 200, "value": None}
+
+        if request_type == "exec":
+            mbeans[request["mbean"]]
+            operation = request["operation"].split("(")[0]
+            arguments = request.get("arguments", [])
+            if operation == "echo":
+                return {"status": 200, "value": arguments[0]}
+            return {"status": 200, "value": None}
+
+        return {"status": 400, "error": "Unsupported request type %s" % request_type}
+
+    def select(self, values, attribute):
+        if attribute is None:
+            return dict(values)
+        if isinstance(attribute, list):
+            return dict((name, values[name]) for name in attribute if name in values)
+        return {attribute: values[attribute]} if attribute in values else {}
+
+class fake_jolokia_server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, mbean_server, latency=0):
+        HTTPServer.__init__(self, address, jolokia_handler)
+        self.mbean_server = mbean_server
+        self.latency = latency
+
+def start(port=0, latency=0, **kw):
+    """ Start a fake agent in a background thread. Returns the server, whose port is server.server_port """
+    server = fake_jolokia_server(("127.0.0.1", port), fake_mbean_server(**kw), latency)
+    thread = threading.Thread(target=server.serve_forever, name="fakejolokia")
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--port", type="int", default=0, help="Port to listen on, 0 for any free port - default: %default")
+    parser.add_option("--mbeans", type="int", default=1000, help="Number of mbeans - default: %default")
+    parser.add_option("--attributes", type="int", default=10, help="Numeric attributes per mbean - default: %default")
+    parser.add_option("--payload", type="int", default=64, help="Bytes in the Payload string attribute - default: %default")
+    parser.add_option("--domains", type="int", default=10, help="Number of domains - default: %default")
+    parser.add_option("--latency", type="float", default=0, help="Milliseconds added to each request - default: %default")
+    (options, args) = parser.parse_args()
+
+    server = fake_jolokia_server(("127.0.0.1", options.port),
+                                 fake_mbean_server(options.mbeans, options.attributes, options.payload, options.domains),
+                                 options.latency / 1000.0)
+    # The benchmark runner reads the port from the first line
+    print server.server_port
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
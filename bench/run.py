@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Offline benchmarks of jmxfuse against the fake Jolokia agent in fakejolokia.py.
+
+    Measures the first listing of the mount, building and rescanning the tree, walking the
+    whole tree, reading attributes and invoking an operation, and prints the results as JSON.
+
+    By default the fuse callbacks of jmx_fuse.core.JmxFuse are called in this process, which
+    measures jmxfuse without the kernel. --mount mounts scripts/jmxfuse instead, which needs
+    fuse and fusermount, and measures what a shell sees.
+
+    @license: GPL
+    @copyright: Alastair McCormack
+    @author: Alastair McCormack
+    @contact: alastair@mcc-net.co.uk
+"""
+
+import os
+import sys
+import json
+import time
+import optparse
+import tempfile
+import platform
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+SCRIPT = os.path.join(os.path.dirname(BENCH_DIR), "scripts", "jmxfuse")
+
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fakejolokia
+
+def summarise(timings):
+    """ Returns the count, mean, median, 99th percentile and maximum of timings, in milliseconds """
+    timings = sorted(timings)
+    if not timings:
+        return {"count": 0}
+    def percentile(fraction):
+        return timings[min(len(timings) - 1, int(fraction * len(timings)))] * 1000
+    return {"count": len(timings),
+            "mean_ms": sum(timings) * 1000 / len(timings),
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+            "max_ms": timings[-1] * 1000}
+
+def timed(fn, *args):
+    """ Returns (seconds, result of fn) """
+    start = time.time()
+    result = fn(*args)
+    return (time.time() - start, result)
+
+class in_process_driver(object):
+    """ Calls the fuse callbacks of JmxFuse directly """
+
+    def __init__(self, port, options):
+        from jmx_fuse import core
+        self.core = core
+        self.jmx_fuse = core.JmxFuse()
+        self.jmx_fuse.init(host="127.0.0.1", port=port, rescan="60m", metadata=options.metadata,
+                           cache_ttl=options.cache_ttl, metadata_cache=options.metadata_cache)
+
+    def listdir(self, path):
+        entries = []
+        for entry in self.jmx_fuse.readdir(path, 0):
+            if isinstance(entry, int):
+                raise OSError(-entry, os.strerror(-entry), path)
+            if entry.name not in (".", ".."):
+                entries.append(entry.name)
+        return entries
+
+    def isdir(self, path):
+        result = self.jmx_fuse.getattr(path)
+        if isinstance(result, int):
+            raise OSError(-result, os.strerror(-result), path)
+        return bool(result.st_mode & 040000)
+
+    def read(self, path):
+        fh = self.jmx_fuse.open(path, os.O_RDONLY)
+        if isinstance(fh, int) and fh < 0:
+            raise OSError(-fh, os.strerror(-fh), path)
+        try:
+            data = []
+            offset = 0
+            while True:
+                chunk = self.jmx_fuse.read(path, 65536, offset, fh)
+                if isinstance(chunk, int):
+                    raise OSError(-chunk, os.strerror(-chunk), path)
+                if not chunk:
+                    return "".join(data)
+                data.append(chunk)
+                offset += len(chunk)
+        finally:
+            self.jmx_fuse.release(path, os.O_RDONLY, fh)
+
+    def write(self, path, data):
+        result = self.jmx_fuse.write(path, data, 0)
+        if result < 0:
+            raise OSError(-result, os.strerror(-result), path)
+
+    def get_tree_manager(self):
+        return self.jmx_fuse.mount_manager.get_tree_managers()[0]
+
+    def close(self):
+        pass
+
+class mount_driver(object):
+    """ Mounts scripts/jmxfuse and uses the mount like a shell would """
+
+    def __init__(self, port, options):
+        self.mount_point = tempfile.mkdtemp(prefix="jmxfuse-bench-")
+        mount_options = "host=127.0.0.1,port=%d,metadata=%s,cache_ttl=%s" % (port, options.metadata, options.cache_ttl)
+        if options.metadata_cache:
+            mount_options += ",metadata_cache=%s" % options.metadata_cache
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([SRC_DIR] + filter(None, [env.get("PYTHONPATH")]))
+        self.process = subprocess.Popen([sys.executable, SCRIPT, self.mount_point, "-f", "-o", mount_options], env=env)
+        # Wait for the mount to appear
+        deadline = time.time() + 30
+        while not os.path.ismount(self.mount_point):
+            if self.process.poll() is not None or time.time() > deadline:
+                self.close()
+                raise RuntimeError("jmxfuse failed to mount %s" % self.mount_point)
+            time.sleep(0.05)
+
+    def real_path(self, path):
+        return self.mount_point + path
+
+    def listdir(self, path):
+        return os.listdir(self.real_path(path))
+
+    def isdir(self, path):
+        return os.path.isdir(self.real_path(path))
+
+    def read(self, path):
+        with open(self.real_path(path)) as fs_file:
+            return fs_file.read()
+
+    def write(self, path, data):
+        with open(self.real_path(path), "w") as fs_file:
+            fs_file.write(data)
+
+    def get_tree_manager(self):
+        return None
+
+    def close(self):
+        subprocess.call(["fusermount", "-u", self.mount_point])
+        self.process.wait()
+        os.rmdir(self.mount_point)
+
+def join(path, name):
+    return path.rstrip("/") + "/" + name
+
+def walk(driver, path="/"):
+    """ Lists every directory below path, like ls -R. Returns the number of entries """
+    count = 0
+    for name in driver.listdir(path):
+        count += 1
+        child_path = join(path, name)
+        if driver.isdir(child_path):
+            count += walk(driver, child_path)
+    return count
+
+def find_mbean_paths(driver, count):
+    """ Returns the paths of up to count of the mbean directories of the benchmark mbeans """
+    mbean_paths = []
+    directories = ["/"]
+    while directories and len(mbean_paths) < count:
+        path = directories.pop(0)
+        names = driver.listdir(path)
+        if "attributes" in names:
+            # Leaves out java.lang:type=Runtime
+            if "Attr0" in driver.listdir(join(path, "attributes")):
+                mbean_paths.append(path)
+            continue
+        for name in sorted(names):
+            if not name.startswith(".") and driver.isdir(join(path, name)):
+                directories.append(join(path, name))
+    return mbean_paths
+
+def parse_calls(contents):
+    """ Returns the rows of .stats/calls as a dict of call name to a dict of column to value """
+    lines = contents.splitlines()
+    columns = [column.replace(" ms", "_ms") for column in ["count", "errors", "mean ms", "p50 ms", "p99 ms", "max ms"]]
+    calls = {}
+    for line in lines[1:]:
+        fields = line.split()
+        calls[fields[0]] = dict(zip(columns, [float(field) for field in fields[1:]]))
+    return calls
+
+def bench_rescan(tree_manager, port):
+    """ Times tree builds: with no changes, after registering and after unregistering mbeans """
+    results = {}
+    (results["unchanged_s"], ignore) = timed(tree_manager.build_tree)
+    (results["forced_s"], ignore) = timed(tree_manager.build_tree, True)
+    control(port, {"register": 10})
+    (results["registered_s"], ignore) = timed(tree_manager.build_tree)
+    control(port, {"unregister": 10})
+    (results["unregistered_s"], ignore) = timed(tree_manager.build_tree)
+    return results
+
+def control(port, request):
+    import requests
+    requests.post("http://127.0.0.1:%d/control" % port, data=json.dumps(request)).raise_for_status()
+
+def run(options):
+    if options.agent_port:
+        port = options.agent_port
+        agent = None
+    else:
+        agent = fakejolokia.start(latency=options.latency / 1000.0, mbeans=options.mbeans,
+                                  attributes=options.attributes, payload=options.payload, domains=options.domains)
+        port = agent.server_port
+
+    results = {"config": dict(vars(options), python=platform.python_version()), "results": {}}
+    timings = results["results"]
+
+    (timings["mount_s"], driver) = timed(mount_driver if options.mount else in_process_driver, port, options)
+    try:
+        (timings["first_ls_s"], root_entries) = timed(driver.listdir, "/")
+        timings["root_entries"] = len(root_entries)
+
+        mbean_paths = find_mbean_paths(driver, options.reads)
+        attribute_paths = [join(path, "attributes/Attr0") for path in mbean_paths]
+
+        # First reads fetch the info of each mbean (with metadata=lazy) as well as the value
+        timings["first_read"] = summarise([timed(driver.read, path)[0] for path in attribute_paths])
+
+        read_times = []
+        start = time.time()
+        for i in xrange(options.repeat):
+            for path in attribute_paths:
+                read_times.append(timed(driver.read, path)[0])
+        elapsed = time.time() - start
+        timings["read"] = summarise(read_times)
+        timings["reads_per_s"] = elapsed and len(read_times) / elapsed
+
+        timings["read_all"] = summarise([timed(driver.read, join(path, "attributes/.all"))[0] for path in mbean_paths])
+
+        invoke_times = []
+        if mbean_paths:
+            invoke_path = join(mbean_paths[0], "operations/echo/invoke")
+            for i in xrange(options.invokes):
+                invoke_times.append(timed(driver.write, invoke_path, "hello jmxfuseid:bench%d\n" % i)[0])
+        timings["invoke"] = summarise(invoke_times)
+
+        # Walks every mbean directory, so by now every mbean has been fetched
+        (timings["walk_s"], timings["walk_entries"]) = timed(walk, driver)
+        (timings["rewalk_s"], ignore) = timed(walk, driver)
+
+        tree_manager = driver.get_tree_manager()
+        if tree_manager:
+            timings["rescan"] = bench_rescan(tree_manager, port)
+            timings["tree_nodes"] = tree_manager.count_nodes()
+
+        timings["calls"] = parse_calls(driver.read("/.stats/calls"))
+    finally:
+        driver.close()
+        if agent:
+            agent.shutdown()
+    return results
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--mbeans", type="int", default=1000, help="Number of mbeans served by the fake agent - default: %default")
+    parser.add_option("--attributes", type="int", default=10, help="Numeric attributes per mbean - default: %default")
+    parser.add_option("--payload", type="int", default=64, help="Bytes in the Payload string attribute - default: %default")
+    parser.add_option("--domains", type="int", default=10, help="Number of domains - default: %default")
+    parser.add_option("--latency", type="float", default=0, help="Milliseconds added to each request by the agent - default: %default")
+    parser.add_option("--agent-port", type="int", default=None, help="Use a fake agent already running on this port, e.g. python fakejolokia.py")
+    parser.add_option("--metadata", type="choice", choices=["lazy", "full", "parallel"], default="lazy", help="jmxfuse metadata option - default: %default")
+    parser.add_option("--metadata-cache", type="string", default=None, help="jmxfuse metadata_cache directory. Run twice against --agent-port to time a remount")
+    parser.add_option("--cache-ttl", type="string", default="0", help="jmxfuse cache_ttl option. 0 makes every read go to the agent - default: %default")
+    parser.add_option("--reads", type="int", default=100, help="Number of mbeans to read an attribute of - default: %default")
+    parser.add_option("--repeat", type="int", default=10, help="Times each attribute is read - default: %default")
+    parser.add_option("--invokes", type="int", default=100, help="Number of operation invocations - default: %default")
+    parser.add_option("--mount", action="store_true", default=False, help="Mount scripts/jmxfuse rather than calling it in process")
+    parser.add_option("--output", type="string", default=None, help="File to write the JSON results to - default: stdout")
+    (options, args) = parser.parse_args()
+
+    results = run(options)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print output
+
+if __name__ == "__main__":
+    main()
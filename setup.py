@@ -10,7 +10,7 @@ setup(name='jmxfuse',
       url='http://code.google.com/p/jmxfuse/',
       packages=['jmx_fuse'],
       package_dir = {'': 'src'},
-      scripts =['scripts/jmxfuse'],
+      scripts =['scripts/jmxfuse', 'scripts/jmxfuse-capture'],
       license = "GNU GPLv3",
       classifiers=['License :: OSI Approved :: GNU Lesser General Public License v3 (LGPLv3)',
                    'Development Status :: 3 - Alpha',
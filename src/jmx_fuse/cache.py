@@ -0,0 +1,217 @@
+"""
+    Attribute value cache - Holds recently read mbean attribute values
+    Metadata cache - Keeps the info of every mbean of a server on disk between mounts
+
+    @license: GPL
+    @copyright: Alastair McCormack
+    @author: Alastair McCormack
+    @contact: alastair@mcc-net.co.uk
+"""
+
+import os
+import re
+import logging
+import marshal
+import time
+import threading
+from fnmatch import fnmatchcase
+from collections import OrderedDict
+import jolokiaparser
+
+class NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+
+def parse_ttl(ttl):
+    """ Returns a time to live, given as a number followed by an optional s, m or h
+        modifier, in seconds. Defaults to seconds if no modifier is given """
+    ttl_match = re.match("^\s*(\d+(?:\.\d+)?)\s*([smh]?)\s*$", str(ttl), re.IGNORECASE)
+    if not ttl_match:
+        raise ValueError("Invalid time to live: %s" % ttl)
+
+    seconds = float(ttl_match.group(1))
+    modifier = ttl_match.group(2).lower()
+    if modifier == "m":
+        seconds *= 60
+    elif modifier == "h":
+        seconds *= 3600
+    return seconds
+
+class ttl_policy(object):
+    """ Chooses the time to live of an attribute value by the object name of its mbean
+        and the name of the attribute. The first matching rule wins """
+
+    def __init__(self, default_ttl=0):
+        self.default_ttl = default_ttl
+        # List of (object name pattern, attribute name glob, ttl)
+        self.rules = []
+
+    def add_rule(self, object_name_glob, attribute_glob, ttl):
+        # A glob without a ":" is a domain and matches all of its mbeans
+        if ":" not in object_name_glob:
+            object_name_glob += ":*"
+        self.rules.append( (object_name_glob, attribute_glob, ttl) )
+
+    def load(self, policy_file_name):
+        """ Read rules from a policy file. Each line holds an object name or domain glob,
+            an attribute name glob and a time to live, separated by white space, e.g.
+
+            java.lang:type=Runtime          *                   1h
+            java.lang:type=Memory           HeapMemoryUsage     1s
+            Catalina                        *                   10s
+
+            Object names may contain spaces. Lines starting with # are ignored """
+        policy_file = open(policy_file_name)
+        try:
+            for (line_no, line) in enumerate(policy_file):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+
+                rule = line.rsplit(None, 2)
+                if len(rule) != 3:
+                    raise ValueError("%s line %s: expected object name, attribute and ttl" %
+                                     (policy_file_name, line_no + 1))
+                self.add_rule(rule[0], rule[1], parse_ttl(rule[2]))
+        finally:
+            policy_file.close()
+
+    def get_ttl(self, object_name, attribute_name):
+        for (object_name_glob, attribute_glob, ttl) in self.rules:
+            # Jolokia sorts the keys of object names, so they are matched as patterns, not globs
+            if jolokiaparser.object_name_matches(object_name_glob, object_name) and fnmatchcase(attribute_name, attribute_glob):
+                return ttl
+        return self.default_ttl
+
+class value_cache(object):
+    """ A cache of attribute values keyed by mbean object name, attribute name and, for items
+        of composite values, the path of the item. Values expire after the time to live given
+        by the policy for the attribute. Once max_entries is reached the least recently used 
+        value is evicted """
+
+    def __init__(self, policy=None, max_entries=10000):
+        self.policy = policy or ttl_policy()
+        self.max_entries = max_entries
+        # (object name, attribute name) + item path -> (expiry time, value), least recently used first
+        self.entries = OrderedDict()
+        # (object name, attribute name) -> number of times the attribute has been invalidated
+        self.generations = {}
+        self.lock = threading.Lock()
+        # Lookups which found, or didn't find, a fresh value
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, object_name, attribute_name, path=()):
+        """ Returns (True, value) if there is a fresh value in the cache, otherwise (False, None) """
+        key = (object_name, attribute_name) + tuple(path)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[0] > time.time():
+                # Move to the most recently used end
+                self.entries[key] = entry
+                self.hits += 1
+                return (True, entry[1])
+            self.misses += 1
+        return (False, None)
+
+    def get(self, object_name, attribute_name, fetch, path=()):
+        """ Returns the cached value, or calls fetch() to get and cache a fresh one """
+        (found, value) = self.lookup(object_name, attribute_name, path)
+        if found:
+            return value
+
+        # Fetch outside of the lock so that slow reads don't hold up other threads. A write 
+        # made meanwhile invalidates the attribute, and the value fetched may be from before it
+        with self.lock:
+            generation = self.generations.get( (object_name, attribute_name), 0)
+        value = fetch()
+        self.put(object_name, attribute_name, value, path, generation)
+        return value
+
+    def needs_fetch(self, object_name, attribute_name):
+        """ True if the value is cacheable but there is no fresh value in the cache """
+        with self.lock:
+            entry = self.entries.get( (object_name, attribute_name) )
+            if entry and entry[0] > time.time():
+                return False
+        return self.policy.get_ttl(object_name, attribute_name) > 0
+
+    def put(self, object_name, attribute_name, value, path=(), generation=None):
+        """ Cache a value. If generation is given, the value isn't cached if the attribute has 
+            been invalidated since generation was looked up """
+        ttl = self.policy.get_ttl(object_name, attribute_name)
+        if ttl <= 0:
+            return
+
+        key = (object_name, attribute_name) + tuple(path)
+        with self.lock:
+            if generation is not None and self.generations.get( (object_name, attribute_name), 0) != generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, object_name, attribute_name):
+        """ Forget the value of an attribute and of all of its items, and any value being 
+            fetched for them """
+        with self.lock:
+            attribute_key = (object_name, attribute_name)
+            self.generations[attribute_key] = self.generations.get(attribute_key, 0) + 1
+            for key in [key for key in self.entries if key[:2] == (object_name, attribute_name)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class metadata_cache(object):
+    """ The info of every mbean of each server, saved in a directory so that a remount can
+        build its tree without fetching it again. Each server has a file named after its host 
+        and port. It starts with a header holding the start time of the JVM, so that the cache
+        of an earlier run is detected without reading the rest. The info of each mbean is kept
+        as JSON text, to be decoded only when the mbean is used """
+    
+    # Changed whenever the layout of the file changes
+    FORMAT = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_file_name(self, host, port):
+        return os.path.join(self.directory, re.sub(r"[^\w.-]", "_", "%s_%s" % (host, port)) + ".cache")
+
+    def load(self, host, port, start_time):
+        """ Returns a dict of object name to info as JSON text, or None if there is no cache 
+            for this run of the JVM """
+        file_name = self.get_file_name(host, port)
+        try:
+            cache_file = open(file_name, "rb")
+            try:
+                if marshal.load(cache_file) != (self.FORMAT, host, port, start_time):
+                    log.debug("Metadata cache %s is of another JVM", file_name)
+                    return None
+                return marshal.load(cache_file)
+            finally:
+                cache_file.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            log.debug("No usable metadata cache in %s", file_name, exc_info=True)
+            return None
+
+    def save(self, host, port, start_time, mbean_infos):
+        """ Save a dict of object name to info as JSON text. The file is replaced in one step, 
+            so a crash never leaves half a cache """
+        file_name = self.get_file_name(host, port)
+        temp_file_name = "%s.%s.tmp" % (file_name, os.getpid())
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        cache_file = open(temp_file_name, "wb")
+        try:
+            marshal.dump( (self.FORMAT, host, port, start_time), cache_file)
+            marshal.dump(mbean_infos, cache_file)
+        finally:
+            cache_file.close()
+        os.rename(temp_file_name, file_name)
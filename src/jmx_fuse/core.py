@@ -9,12 +9,16 @@
     @contact: alastair@mcc-net.co.uk
 """
 
+import os
 import errno  
 import fuse  #@UnresolvedImport - no fuse on Windows :(
 import logging
 import tm
 import jolokiaparser
+import snapshotparser
+import stats
 import sys
+from multiprocessing.pool import ThreadPool
   
 fuse.fuse_python_api = (0, 2)
         
@@ -22,18 +26,65 @@ class JmxFuse(fuse.Fuse):
     """The main Fuse core. Implemented filesystem operation are defined here"""
     
     def __init__(self, *args, **kw):  
+        # Callbacks are dispatched on several threads, so that a slow JMX call doesn't hold up
+        # every other request. -s runs them all on a single thread
+        kw.setdefault("dash_s_do", "setsingle")
         fuse.Fuse.__init__(self, *args, **kw)
     
-    def init(self, host, port, rescan="60m", encoding="utf-8", backend="jolokia", *args, **kw):
+    def init(self, host, port, rescan="60m", encoding="utf-8", backend="jolokia", metadata="lazy",
+             pool_size=10, timeout=30, connect_timeout=5, cache_ttl="1s", cache_policy=None, cache_size=10000,
+             metadata_workers=8, sample=None, sample_interval="10s", sample_size=60,
+             entry_timeout=None, attr_timeout=None, negative_timeout=None, invoke="sync", invoke_workers=4,
+             results_count=100, results_bytes=1048576, metadata_cache=None, *args, **kw):
         # not using fsinit() so that connection errors can be caught and thrown before it's too late
         self.host = host
         self.port = port
         self.rescan = rescan
         self.encoding = encoding
         self.backend = backend
+        self.metadata = metadata
         
-        mbean_server = self.backend(self.host, self.port)
-        tm.jmx_tree_manager.init(mbean_server, self.rescan)
+        # Seconds for which the kernel may cache lookups, attributes and failed lookups 
+        # rather than asking again. Passed on to fuse
+        for (option, seconds) in (("entry_timeout", entry_timeout), ("attr_timeout", attr_timeout),
+                                  ("negative_timeout", negative_timeout)):
+            if seconds is not None:
+                self.fuse_args.add(option, str(seconds))
+        
+        def connect(target):
+            (target_host, target_port) = target
+            return self.backend(target_host, target_port, pool_size=pool_size, timeout=timeout,
+                                connect_timeout=connect_timeout)
+        
+        # The cache is first used once fuse has daemonised and changed directory to /. The shell
+        # doesn't expand ~ within -o either
+        if metadata_cache:
+            metadata_cache = os.path.abspath(os.path.expanduser(metadata_cache))
+        
+        # Connect to all servers at once so that each one doesn't add to mount time.
+        # The threads are finished before fuse daemonises
+        targets = self.parse_targets(self.host, self.port)
+        connect_pool = ThreadPool(len(targets))
+        try:
+            mbean_servers = connect_pool.map(connect, targets)
+        finally:
+            connect_pool.close()
+            connect_pool.join()
+        
+        tree_managers = [tm.jmx_tree_manager(mbean_server, self.rescan, self.metadata, cache_ttl, cache_policy, cache_size,
+                                             metadata_workers, sample, sample_interval, sample_size,
+                                             invoke, invoke_workers, results_count, results_bytes, metadata_cache)
+                         for mbean_server in mbean_servers]
+        self.mount_manager = tm.jmx_mount_manager(tree_managers)
+        
+    def parse_targets(self, hosts, default_port):
+        """ Returns a list of (host, port) from a + separated list of host[:port]. Not commas,
+            as fuse splits -o options on commas """
+        targets = []
+        for target in hosts.split("+"):
+            (target_host, sep, target_port) = target.strip().partition(":")
+            targets.append( (target_host, int(target_port or default_port)) )
+        return targets
         
     def test(self):
         self.backend.test()
@@ -45,96 +96,110 @@ class JmxFuse(fuse.Fuse):
     @backend.setter
     def backend(self, backend_name):
         # TODO: Find all backend plugins available
-        # For now it is just hard coded
-        self._backend = jolokiaparser.Jolokia_server
+        backends = {"jolokia": jolokiaparser.Jolokia_server,
+                    "snapshot": snapshotparser.Snapshot_server}
+        if backend_name not in backends:
+            raise ValueError("Unknown backend: %s. Choose from %s" % (backend_name, ", ".join(sorted(backends))))
+        self._backend = backends[backend_name]
     
-#    def fsinit(self): 
-#        pass     
+    def fsinit(self):
+        # Called once fuse has daemonised, so the background threads survive the fork
+        self.mount_manager.start_refreshers()
+        self.mount_manager.start_samplers()
    
+    @stats.timed("fuse.getattr")
     def getattr(self, path):
-        logging.debug("Path: " + path)
-        fs_dir = tm.jmx_tree_manager.get_path(path)
+        logging.debug("Path: %s", path)
+        fs_dir = self.mount_manager.get_path(path)
         
         if not fs_dir:
-            logging.debug("No such file: %s" % path)
+            logging.debug("No such file: %s", path)
             return -errno.ENOENT
 
-        result = fs_dir.get_fuse_stat()
+        return self.__set_owner(fs_dir.get_fuse_stat())
+    
+    @stats.timed("fuse.fgetattr")
+    def fgetattr(self, path, fh=None):
+        # Open handles report the exact size of their snapshot
+        if not hasattr(fh, "get_fuse_stat"):
+            return self.getattr(path)
+        return self.__set_owner(fh.get_fuse_stat())
         
+    def __set_owner(self, result):
         # Add runtime uid and gid
         result.st_uid = self.GetContext()["uid"]
         result.st_gid = self.GetContext()["gid"]
         
-        logging.debug("Size: %s" % result.st_size)
+        logging.debug("Size: %s", result.st_size)
         return result
         
+    @stats.timed("fuse.readdir")
     def readdir(self, path, offset):
-        logging.debug("Path: %s" % path)
-        fs_dir = tm.jmx_tree_manager.get_path(path)
+        logging.debug("Path: %s", path)
+        fs_dir = self.mount_manager.get_path(path)
         
         if not fs_dir:
-            logging.debug("No such file: %s" % path)
+            logging.debug("No such file: %s", path)
             yield -errno.ENOENT
         
         for child_dir in fs_dir.get_children():
-            logging.debug("Returning Child dir: %s" % child_dir.get_name() )
-            yield  fuse.Direntry(child_dir.get_path().encode(self.encoding))
-        
-#    def open(self, path, flags):  
-#        # Only support for 'READ ONLY' flag  
-#        access_flags = os.O_RDONLY | os.O_WRONLY | os.O_RDWR  
-#        if flags & access_flags != os.O_RDONLY:  
-#            return -errno.EACCES  
-#        else:  
-#            return 0  
+            logging.debug("Returning Child dir: %s", child_dir.get_name() )
+            yield  fuse.Direntry(child_dir.get_encoded_name(self.encoding))
         
+    @stats.timed("fuse.read")
     def read(self, path, length, offset, fh=None):
-        logging.debug("Path: %s" % path)
-        logging.debug("Read size: %s" % length)
-        logging.debug("Read offset: %s" % offset)
-        logging.debug("File Handle: %s" % fh)
+        logging.debug("Path: %s", path)
+        logging.debug("Read size: %s", length)
+        logging.debug("Read offset: %s", offset)
+        logging.debug("File Handle: %s", fh)
+        
+        if hasattr(fh, "read"):
+            # Served from the snapshot taken by the handle
+            return fh.read(length, offset)
         
-        fs_file = tm.jmx_tree_manager.get_path(path)
+        fs_file = self.mount_manager.get_path(path)
         if not fs_file:
-            logging.debug("No such file: %s" % path)
+            logging.debug("No such file: %s", path)
             return -errno.ENOENT
         
         return fs_file.read(path, length, offset, fh).encode(self.encoding)
     
-    def write(self, path, buf, offset):
-        fs_file = tm.jmx_tree_manager.get_path(path)
+    @stats.timed("fuse.write")
+    def write(self, path, buf, offset, fh=None):
+        fs_file = self.mount_manager.get_path(path)
         
         if not fs_file:
-            logging.debug("No such file: %s" % path)
+            logging.debug("No such file: %s", path)
             return -errno.ENOENT
         elif not hasattr(fs_file, "write"):
             logging.debug("Not implemented")
             return -errno.ENOSYS
         
-        logging.debug("Writing to path: %s : %s" % (path, buf))
+        logging.debug("Writing to path: %s : %s", path, buf)
         return fs_file.write(buf.decode(self.encoding), offset)
         
     def chmod ( self, path, mode ):
-        logging.debug( "Path: %s" % path )
-        logging.debug("Mode: %s" % mode)
+        logging.debug("Path: %s", path)
+        logging.debug("Mode: %s", mode)
         
     def chown ( self, path, uid, gid ):
-        logging.debug("Path: %s" % path )
-        logging.debug("uid: %s" % uid)
-        logging.debug("gid: %s" % gid)
+        logging.debug("Path: %s", path)
+        logging.debug("uid: %s", uid)
+        logging.debug("gid: %s", gid)
 
     def utime ( self, path, times ):
-        logging.debug("Path: %s" % path )
-        logging.debug("Times: %s" % str(times) )
+        logging.debug("Path: %s", path)
+        logging.debug("Times: %s", times)
         
+    @stats.timed("fuse.truncate")
     def truncate ( self, path, size ):
-        logging.debug("Path: %s" % path )
-        logging.debug("Truncate Size: %s" % size )
+        logging.debug("Path: %s", path)
+        logging.debug("Truncate Size: %s", size)
         
-        fs_file = tm.jmx_tree_manager.get_path(path)
+        fs_file = self.mount_manager.get_path(path)
         
         if not fs_file:
-            logging.debug("No such file: %s" % path)
+            logging.debug("No such file: %s", path)
             return -errno.ENOENT
         elif not hasattr(fs_file, "truncate"):
             logging.debug("Not implemented")
@@ -146,7 +211,7 @@ class JmxFuse(fuse.Fuse):
     
 #    def opendir(self, path):
 #        logging.debug("Opening dir: %s" % path)
-#        fs_file = tm.jmx_tree_manager.get_path(path)
+#        fs_file = self.mount_manager.get_path(path)
 #        
 #        if not fs_file:
 #            logging.debug("No such file: %s" % path)
@@ -159,7 +224,7 @@ class JmxFuse(fuse.Fuse):
 
 #    def releasedir(self, path):
 #        logging.debug("Releasing dir: %s" % path)
-#        fs_file = tm.jmx_tree_manager.get_path(path)
+#        fs_file = self.mount_manager.get_path(path)
 #        
 #        if not fs_file:
 #            logging.debug("No such file: %s" % path)
@@ -170,35 +235,25 @@ class JmxFuse(fuse.Fuse):
 #
 #        return fs_file.releasedir()
     
-#    def open(self, path, flags):
-#        logging.debug("Opening file: %s" % path)
-#        logging.debug("ino: %s" % flags)
-#        logging.debug("Flags: %s" % flags)
-#        
-#        fs_file = tm.jmx_tree_manager.get_path(path)
-#        if not fs_file:
-#            logging.debug("No such file: %s" % path)
-#            return -errno.ENOENT
-#        elif not hasattr(fs_file, "open"):
-#            logging.debug("Not implemented")
-#            return 0
-#
-#        result = fs_file.open(flags)
-#        logging.debug("Open result: %s" % result)
-#        return result
-#
-#    def release(self, path, ino):
-#        logging.debug("releaseing file: %s" % path)
-#        logging.debug("ino: %s" % ino)
-#        
-#        fs_file = tm.jmx_tree_manager.get_path(path)
-#        if not fs_file:
-#            logging.debug("No such file: %s" % path)
-#            return -errno.ENOENT
-#        elif not hasattr(fs_file, "release"):
-#            logging.debug("Not implemented")
-#            return 0
-#
-#        result = fs_file.release(ino)
-#        logging.debug("Release result: %s" % result)
-#        return result
+    @stats.timed("fuse.open")
+    def open(self, path, flags):
+        logging.debug("Opening file: %s", path)
+        logging.debug("Flags: %s", flags)
+        
+        fs_file = self.mount_manager.get_path(path)
+        if not fs_file:
+            logging.debug("No such file: %s", path)
+            return -errno.ENOENT
+        elif not hasattr(fs_file, "open"):
+            logging.debug("Not implemented")
+            return 0
+        
+        # python-fuse passes the returned handle to read, write, fgetattr and release
+        return fs_file.open(flags, self.encoding)
+
+    @stats.timed("fuse.release")
+    def release(self, path, flags, fh=None):
+        logging.debug("Releasing file: %s", path)
+        if hasattr(fh, "release"):
+            fh.release()
+        return 0
@@ -8,6 +8,7 @@
 
 """
 
+import os
 import sys
 import stat
 import time
@@ -17,11 +18,15 @@ from StringIO import StringIO
 import httplib
 import traceback
 import re
+import json
+import threading
+import weakref
 import fuse #@UnresolvedImport
 import errno
 from datetime import datetime
-import tm
+from collections import deque
 from jmx_fuse.jolokiaparser import Mbean_Operation_Exec_Exception
+from jmx_fuse import stats
 
 class NullHandler(logging.Handler):
     def emit(self, record):
@@ -30,25 +35,47 @@ class NullHandler(logging.Handler):
 log = logging.getLogger(__name__)
 log.addHandler(NullHandler())
 
+class shared_name(unicode):
+    """ A non-ASCII file name, which intern() can't intern as it is unicode """
+    __slots__ = ("__weakref__",)
+
+# Each non-ASCII name in use, e.g. an attribute name common to many mbeans. A name is dropped
+# once no node has it, so names of unregistered mbeans or of lookups aren't kept for good
+unicode_names = weakref.WeakValueDictionary()
+
+def intern_name(name):
+    """ Returns a single shared copy of a file name. ASCII names are kept as byte strings,
+        which readdir can return without encoding them """
+    if isinstance(name, unicode):
+        try:
+            name = name.encode("ascii")
+        except UnicodeEncodeError:
+            shared = unicode_names.get(name)
+            if shared is None:
+                shared = shared_name(name)
+                unicode_names[name] = shared
+            return shared
+    return intern(name)
+
 class FS_Object(object):
-    path = None
+    """ A file or directory. A tree holds hundreds of thousands of these, so they have 
+        __slots__ rather than a __dict__, and leaves have no children. Subclasses with many 
+        instances declare __slots__ for their own attributes. The mode and size are set per class """
+    __slots__ = ("path", "ctime", "mtime")
     mode = 0440
     size = 0
-    #children = None
     links = 1
         
     def __init__(self, path):
-        self.path = path
-        self.children = {}
-        self.atime = int(time.time())
-        self.mtime = self.atime
-        self.ctime = self.atime
+        self.path = intern_name(path)
+        self.ctime = int(time.time())
+        self.mtime = self.ctime
     
     def get_fuse_stat(self):
         st = fuse.Stat()    
         st.st_nlink = self.links
         st.st_mode = self.get_type() | self.get_mode()
-        st.st_atime = self.atime
+        st.st_atime = self.ctime
         st.st_mtime = self.mtime
         st.st_ctime = self.ctime
         st.st_size = self.get_size()
@@ -57,29 +84,23 @@ class FS_Object(object):
     def get_mode(self):
         return self.mode
     
-    def set_mode(self, mode):
-        self.mode = mode
-        
     def get_name(self):
         return self.path
         
     def get_child(self, relative_path_name):
-        if relative_path_name in self.children:
-            return self.children.get(relative_path_name)
-        else:
-            return None
+        return None
     
     def get_children(self):
-        logging.debug("Children: " + ",".join( self.children.keys() ) )
-        print self.children.values()
-        return self.children.values()
+        return []
     
     def get_path(self):
-        logging.debug("FSObject: Path: " + self.path)
         return self.path
     
-#    def get_direntry(self):
-#        return fuse.Direntry( self.get_path().encode("utf-8") )
+    def get_encoded_name(self, encoding):
+        """ The name as returned by readdir """
+        if isinstance(self.path, str):
+            return self.path
+        return self.path.encode(encoding)
     
     def get_size(self):
         """ Get size. If self.size is None then calculate size """
@@ -88,49 +109,120 @@ class FS_Object(object):
         else:
             return len(self.get_contents())
     
-    def set_size(self, size_bytes):
-        self.size = size_bytes
-    
     def get_type(self):
         return self.fs_type
     
+    def touch(self):
+        self.mtime = int(time.time())
+    
     def __str__(self):
         return self.get_path()
     
+class stub_directory(FS_Object):
+    """ "." and "..", shared by all directories """
+    __slots__ = ()
+    fs_type = stat.S_IFDIR
+    
+dot_directory = stub_directory(".")
+dot_dot_directory = stub_directory("..")
+    
 class directory(FS_Object):
+    __slots__ = ("children",)
     fs_type = stat.S_IFDIR
     
     def __init__(self, path):
         super(directory, self).__init__(path)
-        self.children["."] = stub_directory(".")
-        self.children[".."] = stub_directory("..")
+        self.children = {".": dot_directory, "..": dot_dot_directory}
+        
+    def get_child(self, relative_path_name):
+        return self.children.get(relative_path_name)
+    
+    def get_children(self):
+        return self.children.values()
         
     def add_directory(self, child_name):
         if child_name not in self.children:
-            logging.debug("Adding child %s" % child_name)
+            logging.debug("Adding child %s", child_name)
             self.children[child_name] = directory(child_name)
         else:
-            logging.debug("Child %s already exists" % child_name)
+            logging.debug("Child %s already exists", child_name)
         return self.children[child_name]
     
     def add_child(self, child):
         self.children[child.get_path()] = child
         
-class stub_directory(FS_Object):
-    fs_type = stat.S_IFDIR
+    def remove_child(self, child_name):
+        if child_name in self.children:
+            del self.children[child_name]
+            self.touch()
+            
+    def is_empty(self):
+        """ True if the directory contains nothing but "." and ".." """
+        return len(self.children) <= 2
     
 class root_directory(directory):
+    __slots__ = ()
     fs_type = stat.S_IFDIR
     
     def __init__(self):
         path = ""
         super(root_directory, self).__init__(path)
             
+class file_handle(object):
+    """ An open file. The contents of the file are read once, on the first read,
+        and every read of the handle is served from that snapshot """
+    # Read by python-fuse when the handle is returned from open()
+    direct_io = False
+    keep_cache = False
+    
+    def __init__(self, fs_file, flags, encoding):
+        self.fs_file = fs_file
+        self.encoding = encoding
+        access_flags = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
+        self.readable = (flags & access_flags) != os.O_WRONLY
+        self.contents = None
+        # The kernel may read a handle from several threads at once. They must all share one snapshot
+        self.lock = threading.Lock()
+        
+    def get_contents(self):
+        with self.lock:
+            if self.contents is None:
+                contents = self.fs_file.get_contents()
+                if isinstance(contents, unicode):
+                    contents = contents.encode(self.encoding)
+                self.contents = contents
+                self.fs_file.snapshot_taken(self.contents)
+            return self.contents
+    
+    def read(self, length, offset):
+        return self.get_contents()[offset:offset + length]
+    
+    def get_fuse_stat(self):
+        st = self.fs_file.get_fuse_stat()
+        if self.readable:
+            st.st_size = len(self.get_contents())
+        return st
+    
+    def release(self):
+        self.contents = None
+        
 class file(FS_Object):
-    contents = ""
+    __slots__ = ("contents",)
     fs_type = stat.S_IFREG
     # File size will be dynamically generated.
     size = None
+    handle_class = file_handle
+    
+    def __init__(self, path):
+        super(file, self).__init__(path)
+        self.contents = ""
+    
+    def open(self, flags, encoding):
+        return self.handle_class(self, flags, encoding)
+    
+    def snapshot_taken(self, contents):
+        """ Called with the encoded contents whenever a handle reads the file """
+        pass
          
     def get_contents(self):
         # self.contents can be a method to execute first
@@ -150,30 +242,98 @@ class file(FS_Object):
         sio_contents.seek(offset)
         return sio_contents.read(length)
             
+class static_file_handle(file_handle):
+    
+    def __init__(self, fs_file, flags, encoding):
+        super(static_file_handle, self).__init__(fs_file, flags, encoding)
+        # Pages cached by the kernel on the first open may belong to a file which a rescan has
+        # replaced at the same path, so they are only kept from the second open on
+        self.keep_cache = fs_file.opened
+        
+class static_file(file):
+    """ A file whose contents never change, so the kernel may keep them cached between opens """
+    __slots__ = ("opened",)
+    handle_class = static_file_handle
+    
+    def __init__(self, path):
+        super(static_file, self).__init__(path)
+        self.opened = False
+    
+    def open(self, flags, encoding):
+        handle = super(static_file, self).open(flags, encoding)
+        self.opened = True
+        return handle
+        
+class dynamic_file_handle(file_handle):
+    # The size reported by getattr may be out of date, so don't let the kernel limit reads to it
+    direct_io = True
+    
+class dynamic_file(file):
+    """ A file whose contents are fetched from the server each time it is opened """
+    __slots__ = ("last_size",)
+    handle_class = dynamic_file_handle
+    
+    def __init__(self, path):
+        super(dynamic_file, self).__init__(path)
+        self.last_size = 0
+        
+    def get_size(self):
+        # Fetching the contents on every getattr would be too costly, so report the size of the 
+        # last contents read. Open handles report the size of their own snapshot
+        return self.last_size
+    
+    def snapshot_taken(self, contents):
+        self.last_size = len(contents)
+    
 class mbean_directory(directory):
-    """ A class to represent the root of an mbean """
-    mbean = None
+    """ A class to represent the root of an mbean.
+        The contents are only created, and the mbean info fetched, when a child 
+        is first looked up or the directory is listed """
+    __slots__ = ("mbean", "tree_manager", "materialized", "materialize_lock")
     
-    def __init__(self, path, mbean):
+    def __init__(self, path, mbean, tree_manager):
         self.mbean = mbean
+        self.tree_manager = tree_manager
         super(mbean_directory, self).__init__(path)
+        self.materialized = False
+        self.materialize_lock = threading.Lock()
+        
+    def get_child(self, relative_path_name):
+        self.materialize()
+        return super(mbean_directory, self).get_child(relative_path_name)
+    
+    def get_children(self):
+        self.materialize()
+        return super(mbean_directory, self).get_children()
+        
+    def materialize(self):
+        if self.materialized:
+            return
+        # Other threads looking up the directory wait until it is complete
+        with self.materialize_lock:
+            if not self.materialized:
+                self.__materialize()
+                self.materialized = True
+    
+    def __materialize(self):
         error_file_contents = ""
         
         try:
-            classname_file = file("classname")
+            classname_file = static_file("classname")
             classname_file.set_contents(self.mbean.get_class_name() )
             
-            description_file = file("description")
+            description_file = static_file("description")
             description_file.set_contents(self.mbean.get_description() )
             
-            object_name_file = file("objectname")
+            object_name_file = static_file("objectname")
             object_name_file.set_contents(self.mbean.get_object_name() )
             
-            attributes_dir = mbean_attributes_directory("attributes", self.mbean)
+            attributes_dir = mbean_attributes_directory("attributes", self.mbean, self.tree_manager)
             self.add_child(attributes_dir)
             
+            # mbean_operations_directory reuses the operations fetched here
             if self.mbean.get_operations():
-                ops_dir = mbean_operations_directory("operations", self.mbean)
+                ops_dir = mbean_operations_directory("operations", self.mbean, self.tree_manager)
                 self.add_child(ops_dir)
             
             self.add_child(classname_file)
@@ -187,19 +347,61 @@ class mbean_directory(directory):
                 logging.warning(error_file_contents)
                 error_file = file("error")
                 error_file.set_contents(error_file_contents)
-                error_file.set_size(None)
                 self.add_child(error_file)
                                 
 class mbean_attributes_directory(directory):
-        mbean = None
+        """ Listing the directory, or looking up an attribute without a fresh value in the 
+            value cache, reads the values of all attributes missing from it with one request """
+        __slots__ = ("mbean", "tree_manager", "prefetch_expiry")
         
-        def __init__(self, path, mbean):
+        def __init__(self, path, mbean, tree_manager):
             super(mbean_attributes_directory, self).__init__(path)
             self.mbean = mbean
+            self.tree_manager = tree_manager
+            # Until then another prefetch would read nothing new, or fail again
+            self.prefetch_expiry = 0
             for mbean_attr in self.mbean.get_attributes():
-                logging.debug("Create attribute file for attribute: %s" % mbean_attr.get_name() )
-                new_attribute_file = mbean_attribute(mbean_attr.get_name(), mbean_attr)
+                if mbean_attr.read and mbean_attr.is_composite():
+                    logging.debug("Create attribute directory for attribute: %s", mbean_attr.get_name())
+                    new_attribute_dir = mbean_attribute_directory(mbean_attr.get_name(), mbean_attr, self.tree_manager)
+                    self.add_child(new_attribute_dir)
+                    continue
+                logging.debug("Create attribute file for attribute: %s", mbean_attr.get_name())
+                new_attribute_file = mbean_attribute(mbean_attr.get_name(), mbean_attr, self.tree_manager)
                 self.add_child(new_attribute_file)
+            
+            self.add_child(mbean_attributes_all_file(".all", self.mbean, self.tree_manager))
+            
+            sampler = self.tree_manager.sampler
+            if sampler:
+                sampled_attributes = sampler.get_sampled_attributes(self.mbean)
+                if sampled_attributes:
+                    history_dir = directory(".history")
+                    for attribute_name in sampled_attributes:
+                        history_dir.add_child(mbean_attribute_history(attribute_name, self.mbean, sampler))
+                    self.add_child(history_dir)
+                
+        def get_child(self, relative_path_name):
+            child = super(mbean_attributes_directory, self).get_child(relative_path_name)
+            # .all does its own bulk read and .history doesn't read from the server
+            if isinstance(child, (mbean_attribute, mbean_attribute_directory)) and time.time() >= self.prefetch_expiry and \
+                    self.tree_manager.value_cache.needs_fetch(self.mbean.get_object_name(), relative_path_name):
+                self.prefetch()
+            return child
+        
+        def get_children(self):
+            if time.time() >= self.prefetch_expiry:
+                self.prefetch()
+            return super(mbean_attributes_directory, self).get_children()
+        
+        def prefetch(self):
+            try:
+                ttl = self.tree_manager.prefetch_attribute_values(self.mbean)
+            except Exception:
+                # Reads of the individual attributes will report the error
+                log.debug("Prefetching attributes of %s failed", self.mbean.get_object_name(), exc_info=True)
+                ttl = self.tree_manager.value_cache.policy.default_ttl
+            self.prefetch_expiry = time.time() + ttl
                 
 #        def opendir(self):
 #            # The directory has been opened for reading during an ls
@@ -213,23 +415,144 @@ class mbean_attributes_directory(directory):
 #                if isinstance(child, mbean_attribute):
 #                    child.set_real_size_true()
                 
+class mbean_attributes_all_file(dynamic_file):
+    """ Read only file holding all attribute values of an mbean as a JSON object,
+        read with a single request. An attribute which could not be read holds its error """
+    __slots__ = ("mbean", "tree_manager")
+    mode = 0440
+    
+    def __init__(self, path, mbean, tree_manager):
+        super(mbean_attributes_all_file, self).__init__(path)
+        self.mbean = mbean
+        self.tree_manager = tree_manager
+        
+    def get_contents(self):
+        values = self.tree_manager.read_all_attribute_values(self.mbean)
+        return json.dumps(values, indent=2, sort_keys=True, separators=(",", ": ")) + "\n"
+                
+class mbean_attribute_directory(directory):
+    """ A composite or tabular attribute. Its structure is discovered from the whole value
+        when the directory is used and then kept. While the value is null or empty, or can't be 
+        read, each use tries again. Each item is a file, or a directory if it holds items itself,
+        and reading an item file reads only that item from the server """
+    __slots__ = ("attribute", "tree_manager", "materialized", "materialize_lock")
+    
+    def __init__(self, path, attribute, tree_manager):
+        super(mbean_attribute_directory, self).__init__(path)
+        self.attribute = attribute
+        self.tree_manager = tree_manager
+        self.materialized = False
+        self.materialize_lock = threading.Lock()
+        
+    def get_child(self, relative_path_name):
+        self.materialize()
+        return super(mbean_attribute_directory, self).get_child(relative_path_name)
+    
+    def get_children(self):
+        self.materialize()
+        return super(mbean_attribute_directory, self).get_children()
+    
+    def materialize(self):
+        if self.materialized:
+            return
+        with self.materialize_lock:
+            if self.materialized:
+                return
+            # Items are added to a new directory and swapped in whole, so a failure part way
+            # through leaves none of them behind
+            items = directory(self.get_name())
+            try:
+                value = self.tree_manager.get_attribute_value(self.attribute)
+                # e.g. LastGcInfo is null until the first collection
+                if isinstance(value, (dict, list)) and value:
+                    self.add_items(items, value, [])
+                    self.materialized = True
+            except Exception:
+                error_file_contents = traceback.format_exc()
+                logging.warning(error_file_contents)
+                error_file = file("error")
+                error_file.set_contents(error_file_contents)
+                items = directory(self.get_name())
+                items.add_child(error_file)
+            self.children = items.children
+                
+    def add_items(self, parent, value, path):
+        """ Add a child to parent for each item of value, a dict or list, found at path """
+        if isinstance(value, dict):
+            items = value.items()
+        else:
+            items = enumerate(value)
+            
+        for (key, item) in items:
+            # "/" can't be part of a file name
+            name = unicode(key).replace("/", "_")
+            item_path = path + [key]
+            if isinstance(item, (dict, list)) and item:
+                item_dir = directory(name)
+                self.add_items(item_dir, item, item_path)
+                parent.add_child(item_dir)
+            else:
+                parent.add_child(mbean_attribute_item(name, self.attribute, item_path, self.tree_manager))
+                
+class mbean_attribute_item(dynamic_file):
+    """ Read only file holding one item of a composite or tabular attribute """
+    __slots__ = ("attribute", "item_path", "tree_manager")
+    mode = 0440
+    
+    def __init__(self, path, attribute, item_path, tree_manager):
+        super(mbean_attribute_item, self).__init__(path)
+        self.attribute = attribute
+        self.item_path = item_path
+        self.tree_manager = tree_manager
+        
+    def get_contents(self):
+        result = self.attribute.format_value(self.tree_manager.get_attribute_item_value(self.attribute, self.item_path))
+        if result is None:
+            result = ""
+        elif isinstance(result, unicode):
+            return result + u"\n"
+        return str(result) + "\n"
+                
+class mbean_attribute_history(dynamic_file):
+    """ Read only file holding the recent samples of an attribute, one line per sample """
+    __slots__ = ("object_name", "sampler")
+    mode = 0440
+    
+    def __init__(self, path, mbean, sampler):
+        super(mbean_attribute_history, self).__init__(path)
+        self.object_name = mbean.get_object_name()
+        self.sampler = sampler
+        
+    def get_contents(self):
+        history = self.sampler.get_history(self.object_name, self.get_name())
+        if not history:
+            return ""
+        return history.get_contents()
+                
 class mbean_operations_directory(directory):
-        mbean = None
+        __slots__ = ("mbean",)
         
-        def __init__(self, path, mbean):
+        def __init__(self, path, mbean, tree_manager):
             super(mbean_operations_directory, self).__init__(path)
             self.mbean = mbean
             for mbean_op in self.mbean.get_operations():
-                logging.debug("Create operation file for operation: %s" % mbean_op.get_name() )
-                new_method_dir = mbean_operation_method_directory(mbean_op.get_name(), mbean_op)
+                logging.debug("Create operation file for operation: %s", mbean_op.get_name())
+                new_method_dir = mbean_operation_method_directory(mbean_op.get_name(), mbean_op, tree_manager)
                 self.add_child(new_method_dir)
                 
 class mbean_operation_method_directory(directory):
-    mbean_operation = None
+    __slots__ = ("mbean_operation", "tree_manager", "output_lock", "job_names", "invocation_seq")
     
-    def __init__(self, path, mbean_op):
+    def __init__(self, path, mbean_op, tree_manager):
         super(mbean_operation_method_directory, self).__init__(path)
         self.mbean_operation = mbean_op
+        self.tree_manager = tree_manager
+        # Serialises concurrent invocations writing to the error and results files
+        self.output_lock = threading.Lock()
+        # Names of the jobs in jobs, oldest first
+        self.job_names = []
+        # Numbers the invocations without an identifier
+        self.invocation_seq = 0
         
         new_invoke_file = mbean_operation_invoke_file("invoke", self)
         self.add_child(new_invoke_file)
@@ -239,28 +562,152 @@ class mbean_operation_method_directory(directory):
         
         method_description = self.mbean_operation.get_description()
         if method_description:
-            description_file = file("description")
+            description_file = static_file("description")
             description_file.set_contents(method_description)
-            # Return proper size acording to contents
-            description_file.set_size(None)
-            
             self.add_child(description_file)    
         
+    def get_invocation_name(self, unique_id):
+        """ Returns the name of an invocation's entries in results.d and jobs: its identifier,
+            or its sequence number if it has no identifier """
+        name = unique_id.replace("/", "_")
+        if name in (".", ".."):
+            # Would replace the entries of the directory itself
+            name = name.replace(".", "_")
+        with self.output_lock:
+            self.invocation_seq += 1
+            return name or str(self.invocation_seq)
+        
     def write_to_error_file(self, message):
-        error_file = self.get_child("error")
-        if not error_file:
-            error_file = file("error")
-            self.add_child(error_file)
-        error_file.append_contents(message)
-        
-    def write_to_results_file(self, message):
-        results_file = self.get_child("results")
-        if not results_file:
-            results_file = file("results")
-            self.add_child(results_file)
-        results_file.append_contents(message)
-        
-class mbean_operation_usage_file(file):
+        with self.output_lock:
+            error_file = self.get_child("error")
+            if not error_file:
+                error_file = mbean_operation_output_file("error", self.tree_manager.results_count, 
+                                                         self.tree_manager.results_bytes)
+                self.add_child(error_file)
+            error_file.append_message(message)
+        
+    def write_to_results_file(self, message, invocation_name=None):
+        with self.output_lock:
+            results_file = self.get_child("results")
+            if not results_file:
+                results_dir = directory("results.d")
+                results_file = mbean_operation_output_file("results", self.tree_manager.results_count, 
+                                                           self.tree_manager.results_bytes, results_dir)
+                self.add_child(results_dir)
+                self.add_child(results_file)
+            results_file.append_message(message, invocation_name)
+            
+    def add_job(self, job_name):
+        """ Add jobs/<job_name> for an asynchronous invocation. Only as many jobs as results are kept """
+        with self.output_lock:
+            jobs_dir = self.get_child("jobs")
+            if not jobs_dir:
+                jobs_dir = directory("jobs")
+                self.add_child(jobs_dir)
+            
+            if job_name in self.job_names:
+                self.job_names.remove(job_name)
+            job = mbean_operation_job(job_name)
+            jobs_dir.add_child(job)
+            self.job_names.append(job_name)
+            
+            while len(self.job_names) > max(1, self.tree_manager.results_count):
+                jobs_dir.remove_child(self.job_names.pop(0))
+            return job
+        
+class mbean_operation_job(directory):
+    """ jobs/<id> of an asynchronous invocation. status tells whether the invocation is queued,
+        running, done or failed. Reading result waits until the invocation has completed """
+    
+    def __init__(self, path):
+        super(mbean_operation_job, self).__init__(path)
+        self.status = "queued"
+        self.result = None
+        self.completed = threading.Event()
+        self.add_child(mbean_operation_job_file("status", self.get_status))
+        self.add_child(mbean_operation_job_file("result", self.get_result))
+        
+    def run(self, invocation):
+        self.status = "running"
+        try:
+            self.result = invocation()
+            self.status = "done"
+        except Exception, e:
+            logging.exception("Invocation failed")
+            self.result = e
+            self.status = "failed"
+        finally:
+            self.completed.set()
+            
+    def get_status(self):
+        return self.status
+    
+    def get_result(self):
+        self.completed.wait()
+        return self.result
+    
+class mbean_operation_job_file(dynamic_file):
+    mode = 0440
+    
+    def __init__(self, path, get_value):
+        super(mbean_operation_job_file, self).__init__(path)
+        self.get_value = get_value
+        
+    def get_contents(self):
+        value = self.get_value()
+        if value is None:
+            value = ""
+        if isinstance(value, unicode):
+            return value + u"\n"
+        return str(value) + "\n"
+        
+class mbean_operation_output_file(file):
+    """ The results or error file of an operation. Only the messages of the last max_count 
+        invocations, up to max_bytes of them, are kept. A message with a name is also kept 
+        as a file of that name in entries_dir, until it is dropped """
+    handle_class = dynamic_file_handle
+    
+    def __init__(self, path, max_count, max_bytes, entries_dir=None):
+        super(mbean_operation_output_file, self).__init__(path)
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.entries_dir = entries_dir
+        # (entry file or None, message), oldest first
+        self.messages = deque()
+        self.bytes = 0
+        
+    def append_message(self, message, entry_name=None):
+        """ Add a message, dropping the oldest ones beyond the limits. Callers serialise appends """
+        entry = None
+        if self.entries_dir is not None and entry_name:
+            entry = mbean_operation_result(entry_name, message)
+            self.entries_dir.add_child(entry)
+        self.messages.append( (entry, message) )
+        self.bytes += len(message)
+        
+        # The newest message is always kept
+        while len(self.messages) > 1 and (len(self.messages) > self.max_count or self.bytes > self.max_bytes):
+            (old_entry, old_message) = self.messages.popleft()
+            self.bytes -= len(old_message)
+            # Unless a later invocation with the same identifier has replaced it
+            if old_entry and self.entries_dir.get_child(old_entry.get_name()) is old_entry:
+                self.entries_dir.remove_child(old_entry.get_name())
+                
+    def get_contents(self):
+        return "".join(message for (entry, message) in list(self.messages))
+    
+class mbean_operation_result(static_file):
+    """ results.d/<id> holding the result of a single invocation """
+    
+    def __init__(self, path, message):
+        super(mbean_operation_result, self).__init__(path)
+        self.contents = message
+        
+    def get_contents(self):
+        return self.contents
+        
+class mbean_operation_usage_file(static_file):
+    __slots__ = ("mbean_op_method_dir", "mbean_operation", "parameters")
     mode = 0440
     # Size will be calculated on the fly
     size = None
@@ -308,12 +755,10 @@ Arguments may be split by space, tab or carriage return
 class mbean_operation_invoke_file(file):
     """ The invoke file which is used to execute an mbean op.
         It contains a simple usage information """
+    __slots__ = ("mbean_op_method_dir", "mbean_operation", "parameters")
+    mode = 0660
     # Size will be calculated on the fly
     size = None
-           
-    mbean_operation = None
-    parameters = None
-    mbean_op_method_dir = None
         
     def __init__(self, path, mbean_op_method_dir):
         super(mbean_operation_invoke_file, self).__init__(path)
@@ -321,8 +766,6 @@ class mbean_operation_invoke_file(file):
         self.mbean_operation = self.mbean_op_method_dir.mbean_operation
         
         self.parameters = self.mbean_operation.get_paramters()
-
-        self.mode = 0220 | self.mode
         
     def get_contents(self):
         args_string = ""
@@ -338,8 +781,8 @@ class mbean_operation_invoke_file(file):
         return args_string.strip() + "\n"
         
     def write(self, buf, offset):
-        logging.debug("New value: %s" % buf)
-        logging.debug("offset: %s" % offset)
+        logging.debug("New value: %s", buf)
+        logging.debug("offset: %s", offset)
         
         dt = datetime.now()
         timestamp = dt.isoformat()
@@ -349,7 +792,7 @@ class mbean_operation_invoke_file(file):
         else:
             no_req_params = 0
             
-        logging.debug("Number of required args %s" % no_req_params)
+        logging.debug("Number of required args %s", no_req_params)
         
         value_fh = StringIO(buf)
         value_fh.seek(offset)
@@ -367,11 +810,11 @@ class mbean_operation_invoke_file(file):
             match = unique_id_re.match(arg)
             if match:
                 unique_id = match.group(1)
-                log.debug("Unique_id found: %s" % unique_id)
+                log.debug("Unique_id found: %s", unique_id)
                 args.remove(arg)
                 
         
-        logging.debug("Number of supplied args: %s" % len(args))
+        logging.debug("Number of supplied args: %s", len(args))
         logging.debug(args)
         
         if len(args) < no_req_params:
@@ -384,44 +827,61 @@ class mbean_operation_invoke_file(file):
             self.mbean_op_method_dir.write_to_error_file("%s Invalid usage. Too many arguments: %s\n" % (timestamp, value))
             return - errno.EINVAL
         
-        try:    
-            if args:
-                for arg_pos in xrange(len(args)):
-                    parameter = self.parameters[arg_pos]
-                    parameter.set_request_value(args[arg_pos])
-                    
-                result = self.mbean_operation.invoke(self.parameters)
-            else:
-                result = self.mbean_operation.invoke()
-        except Mbean_Operation_Exec_Exception, e:
-                result = e.message
-
-        results_message = "%s %s: %s\n" % (timestamp, unique_id, result or "")
-        self.mbean_op_method_dir.write_to_results_file(results_message)
+        invocation_name = self.mbean_op_method_dir.get_invocation_name(unique_id)
+        
+        def invoke():
+            """ Invoke the operation and record the result. An exception thrown by the operation 
+                is recorded as its result and then raised again, so that its job fails """
+            try:
+                # The arguments belong to this call only
+                result = self.mbean_operation.invoke(args)
+            except Mbean_Operation_Exec_Exception, e:
+                results_message = "%s %s: %s\n" % (timestamp, unique_id, e.message or "")
+                self.mbean_op_method_dir.write_to_results_file(results_message, invocation_name)
+                raise
+            
+            results_message = "%s %s: %s\n" % (timestamp, unique_id, result or "")
+            self.mbean_op_method_dir.write_to_results_file(results_message, invocation_name)
+            return result
+        
+        tree_manager = self.mbean_op_method_dir.tree_manager
+        if tree_manager.invoke == "async":
+            # Return at once. The result turns up in jobs/<id>/result, as well as in results
+            job = self.mbean_op_method_dir.add_job(invocation_name)
+            tree_manager.submit_invocation(lambda: job.run(invoke))
+        else:
+            try:
+                invoke()
+            except Mbean_Operation_Exec_Exception:
+                # Already in the results file
+                pass
                 
         return len(buf)
 
 
-class mbean_attribute(file):
-    attribute = None
-    value = None
-    size = 1048576
+class mbean_attribute(dynamic_file):
+    __slots__ = ("attribute", "tree_manager")
     
-    def __init__(self, attribute_name, attribute):
+    def __init__(self, attribute_name, attribute, tree_manager):
         super(mbean_attribute, self).__init__(attribute_name)
         self.attribute = attribute
-        self.real_size = True
+        self.tree_manager = tree_manager
         
+    def get_mode(self):
+        mode = self.mode
         if self.attribute.read:
-            self.mode = 0440
-            
+            mode = 0440
         if self.attribute.write:
-            self.mode = 0220 | self.mode
+            mode = 0220 | mode
+        return mode
             
     def get_contents(self):
-        result = self.attribute.get_value()
+        result = self.attribute.format_value(self.tree_manager.get_attribute_value(self.attribute))
         if result is None:
             result = ""
+        elif isinstance(result, unicode):
+            # Encoded by the file handle or fuse core
+            return result + u"\n"
         return str(result) + "\n"
             
 #    def get_value(self):
@@ -441,36 +901,169 @@ class mbean_attribute(file):
 #        return sio_contents.read(length)
     
     def write(self, buf, offset):
-        logging.debug("New value: %s" % buf)
-        logging.debug("offset: %s" % offset)
+        logging.debug("New value: %s", buf)
+        logging.debug("offset: %s", offset)
         value_fh = StringIO(buf)
         value_fh.seek(offset)
         try:
-            self.attribute.set_attribute(value_fh.getvalue())
+            self.tree_manager.set_attribute_value(self.attribute, value_fh.getvalue())
         except Exception, e:
             logging.debug(e)
             return errno.EIO
         return len(buf)
     
+class query_directory(directory):
+    """ Reading .query/<objectname pattern>/<attribute> reads the attribute of every mbean 
+        matching the pattern with a single request. Directories for patterns are made on each 
+        lookup and never kept, so that probes and typos don't grow the tree """
+    
+    def __init__(self, path, tree_manager):
+        super(query_directory, self).__init__(path)
+        self.tree_manager = tree_manager
+        
+    def get_child(self, relative_path_name):
+        child = super(query_directory, self).get_child(relative_path_name)
+        if not child and ":" in relative_path_name and not relative_path_name.startswith(".") \
+                and self.tree_manager.matches_mbeans(relative_path_name):
+            child = query_pattern_directory(relative_path_name, self.tree_manager)
+        return child
+    
+class query_pattern_directory(directory):
+    """ Looking up a name gives a file for the attribute of that name """
+    
+    def __init__(self, path, tree_manager):
+        super(query_pattern_directory, self).__init__(path)
+        self.tree_manager = tree_manager
+        
+    def get_child(self, relative_path_name):
+        child = super(query_pattern_directory, self).get_child(relative_path_name)
+        if not child and not relative_path_name.startswith("."):
+            child = query_result_file(relative_path_name, self.get_name(), self.tree_manager)
+        return child
+    
+class query_result_file(dynamic_file):
+    """ Read only file holding the value of an attribute of each mbean matching a pattern, 
+        one "<objectname> <value>" line per mbean """
+    mode = 0440
+    
+    def __init__(self, path, pattern, tree_manager):
+        super(query_result_file, self).__init__(path)
+        self.pattern = pattern
+        self.tree_manager = tree_manager
+        
+    def get_contents(self):
+        values = self.tree_manager.query_attribute_values(self.pattern, self.get_name())
+        lines = []
+        for (object_name, value) in sorted(values.items()):
+            if value is None:
+                value = ""
+            elif isinstance(value, (dict, list)):
+                value = str(value)
+            lines.append(u"%s %s\n" % (object_name, value))
+        return u"".join(lines)
+        
+class stats_directory(directory):
+    """ .stats: counts and latencies of fuse callbacks and backend calls, value cache hit 
+        rates and the size of each tree """
+    
+    def __init__(self, path, mount_manager):
+        super(stats_directory, self).__init__(path)
+        self.mount_manager = mount_manager
+        self.add_child(stats_file("calls", self.get_calls))
+        self.add_child(stats_file("cache", self.get_cache))
+        self.add_child(stats_file("tree", self.get_tree))
+        self.add_child(stats_histograms_directory("histograms"))
+        
+    def get_calls(self):
+        lines = ["%-45s %8s %8s %10s %10s %10s %10s\n" % ("call", "count", "errors", "mean ms", "p50 ms", "p99 ms", "max ms")]
+        for call in stats.registry.get_all_call_stats():
+            mean_time = call.count and call.total_time / call.count
+            lines.append("%-45s %8d %8d %10.3f %10.3f %10.3f %10.3f\n" % 
+                         (call.name, call.count, call.errors, mean_time * 1000, call.get_percentile(0.5) * 1000,
+                          call.get_percentile(0.99) * 1000, call.max_time * 1000))
+        return "".join(lines)
+    
+    def get_cache(self):
+        lines = ["%-30s %8s %10s %10s %8s\n" % ("server", "entries", "hits", "misses", "hit %")]
+        for tree_manager in self.mount_manager.get_tree_managers():
+            value_cache = tree_manager.value_cache
+            lookups = value_cache.hits + value_cache.misses
+            hit_rate = lookups and 100.0 * value_cache.hits / lookups
+            lines.append("%-30s %8d %10d %10d %8.1f\n" % 
+                         (tree_manager.get_name(), len(value_cache.entries), value_cache.hits, value_cache.misses, hit_rate))
+        return "".join(lines)
+    
+    def get_tree(self):
+        lines = ["%-30s %8s %8s  %s\n" % ("server", "mbeans", "nodes", "last build")]
+        for tree_manager in self.mount_manager.get_tree_managers():
+            last_build_time = tree_manager.last_build_time and tree_manager.last_build_time.isoformat()
+            lines.append("%-30s %8d %8d  %s\n" % 
+                         (tree_manager.get_name(), len(tree_manager.mbean_dirs), tree_manager.count_nodes(), last_build_time or "-"))
+        return "".join(lines)
+    
+class stats_histograms_directory(directory):
+    """ A latency histogram file for each kind of call made so far """
+    
+    def get_child(self, relative_path_name):
+        self.add_histograms()
+        return super(stats_histograms_directory, self).get_child(relative_path_name)
+    
+    def get_children(self):
+        self.add_histograms()
+        return super(stats_histograms_directory, self).get_children()
+    
+    def add_histograms(self):
+        for call in stats.registry.get_all_call_stats():
+            if call.name not in self.children:
+                self.add_child(stats_file(call.name, lambda call=call: self.get_histogram(call)))
+                
+    def get_histogram(self, call):
+        """ One "<less than> <calls>" line for each bucket, from the fastest to the slowest call made """
+        histogram = call.get_histogram()
+        used = [bucket for (bucket, (upper_bound, count)) in enumerate(histogram) if count]
+        if not used:
+            return ""
+        lines = []
+        for (upper_bound, count) in histogram[used[0]:used[-1] + 1]:
+            if upper_bound < 0.001:
+                bound = "%dus" % round(upper_bound * 1000000)
+            elif upper_bound < 1:
+                bound = "%gms" % (upper_bound * 1000)
+            else:
+                bound = "%gs" % upper_bound
+            lines.append("<%-10s %d\n" % (bound, count))
+        return "".join(lines)
+    
+class stats_file(dynamic_file):
+    mode = 0440
+    
+    def __init__(self, path, get_contents):
+        super(stats_file, self).__init__(path)
+        self.get_stats = get_contents
+        
+    def get_contents(self):
+        return self.get_stats()
+        
 class file_rescan_interval(file):
     mode = 0660
     
-    def __init__(self, path):
+    def __init__(self, path, tree_manager):
         super(file_rescan_interval, self).__init__(path)
+        self.tree_manager = tree_manager
         
     def get_contents(self):
-        return str(tm.jmx_tree_manager.rescan_interval) + "\n"
+        return str(self.tree_manager.rescan_interval) + "\n"
     
     def truncate(self, size):
-        logging.debug("Truncate size: %s" % size)
+        logging.debug("Truncate size: %s", size)
         sio_contents = StringIO(self.get_contents())
         sio_contents.truncate(size)
         self.write(sio_contents.getvalue())
         return 0
     
     def write(self, buf, offset=0):
-        logging.debug("New value: %s" % buf)
-        logging.debug("offset: %s" % offset)
+        logging.debug("New value: %s", buf)
+        logging.debug("offset: %s", offset)
         
         value_fh = StringIO(buf)
         value_fh.seek(offset)
@@ -478,10 +1071,10 @@ class file_rescan_interval(file):
         match_re = re.match("(\w+)", value_fh.getvalue() )
                 
         if not match_re:
-            logging.debug("Requesting rebuild on next get_path")
-            tm.jmx_tree_manager.rebuild_on_next_request()
+            logging.debug("Requesting rebuild in the background")
+            self.tree_manager.request_rescan()
         else:
-            logging.debug("Setting rescan interval to %s" % match_re.group(0))
-            tm.jmx_tree_manager.set_rescan( match_re.group(0) )
+            logging.debug("Setting rescan interval to %s", match_re.group(0))
+            self.tree_manager.set_rescan( match_re.group(0) )
         return len(buf)
     
\ No newline at end of file
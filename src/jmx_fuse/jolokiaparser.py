@@ -12,8 +12,13 @@
 
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 import re
 import json
+from itertools import izip
+from fnmatch import fnmatchcase
+import stats
+import jsonstream
 
 MBEAN_ACL_READ = 4
 MBEAN_ACL_WRITE = 2
@@ -26,6 +31,31 @@ log = logging.getLogger(__name__)
 log.addHandler(NullHandler())
 
 
+def is_object_name_pattern(object_name):
+    """ True if object_name contains a wildcard and so may match several mbeans """
+    return "*" in object_name or "?" in object_name
+
+def object_name_matches(pattern, object_name):
+    """ True if object_name matches the object name pattern, e.g. java.lang:type=*,* """
+    (pattern_domain, sep, pattern_keys) = pattern.partition(":")
+    (domain, sep, keys) = object_name.partition(":")
+    if not fnmatchcase(domain, pattern_domain):
+        return False
+
+    properties = dict(key_value.split("=", 1) for key_value in keys.split(",") if "=" in key_value)
+    pattern_properties = [key_value.split("=", 1) for key_value in pattern_keys.split(",") if "=" in key_value]
+    for (key, value) in pattern_properties:
+        if key not in properties or not fnmatchcase(properties[key], value):
+            return False
+    # Without a trailing * the mbean may not have any other key properties
+    property_list_pattern = pattern_keys == "*" or pattern_keys.endswith(",*")
+    return property_list_pattern or len(pattern_properties) == len(properties)
+
+def is_error_value(value):
+    """ True if value is the error message which, with ignoreErrors, Jolokia gives in place of
+        the value of an attribute which could not be read """
+    return isinstance(value, basestring) and value.startswith("ERROR: ")
+
 def get_json(response):
         """ Early versions of requests library do not include built-in json support """
         unicode_text = response.text
@@ -104,40 +134,105 @@ class mbean:
     
     def get_attributes(self):
         raise NotImplementedError()
+    
+    def get_attribute_values(self, names=None):
+        """ Returns a dict of attribute name to raw value for the named attributes, 
+            or for all attributes if names is None """
+        result = {}
+        for attribute in self.get_attributes():
+            if names is None or attribute.get_name() in names:
+                result[attribute.get_name()] = attribute.get_raw_value()
+        return result
                
     def get_operations(self):
         raise NotImplementedError()
 
 class Jolokia_mbean(mbean):
+    """ A Jolokia mbean. Its info (the mbean's entry from a Jolokia list response) is either
+        given up front, given as JSON text to be decoded the first time it is needed, or 
+        fetched with a single request the first time it is needed """
+    
+    def __init__(self, name, server, info=None, info_json=None):
+        mbean.__init__(self, name, server)
+        self.info = info
+        self.info_json = info_json
+        self.attributes = None
+        self.operations = None
+        
+    def get_info(self):
+        if self.info is None and self.info_json is not None:
+            self.info = json.loads(self.info_json)
+        if self.info is None:
+            self.info = self.server.get_mbean_info(self)
+        self.server.check_mbean_info(self.info)
+        return self.info
     
     def get_class_name(self):
-        return None
+        return self.get_info().get("class")
     
     def get_description(self):
-        return None
+        return self.get_info().get("desc")
     
     def get_attributes(self):
-        return self.server.get_mbean_attributes(self)
+        if self.attributes is None:
+            self.attributes = list(self.server.parse_mbean_attributes(self, self.get_info().get("attr", {})))
+        return self.attributes
                
     def get_operations(self):
-        return self.server.get_mbean_operations(self)
+        if self.operations is None:
+            self.operations = list(self.server.parse_mbean_operations(self, self.get_info().get("op", {})))
+        return self.operations
+    
+    def get_attribute_values(self, names=None):
+        return self.server.get_mbean_attribute_values(self, names)
         
 class mbean_attribute:
     
-    def __init__(self, name, mbean, read=True, write=False):
+    def __init__(self, name, mbean, read=True, write=False, type=None):
         self.mbean = mbean
         self.name = name
         
         self.read = read
         self.write = write
+        self.type = type
         
     def get_name(self):
         return self.name
     
+    def get_type(self):
+        return self.type
+    
+    def is_composite(self):
+        """ True if the value is open mbean composite or tabular data, i.e. has items which
+            can be read on their own """
+        return bool(self.type) and ("openmbean.CompositeData" in self.type or "openmbean.TabularData" in self.type)
+    
+    def get_value(self):
+        return self.format_value(self.get_raw_value())
+    
+    def get_raw_value(self):
+        """ Returns the value as deserialised by the connector, e.g. a dict for composite data """
+        raise NotImplementedError()
+    
+    def get_raw_item_value(self, path):
+        """ Returns only the item of a composite or tabular value at path, a list of keys and list indexes """
+        raise NotImplementedError()
+    
+    def format_value(self, value):
+        # If value is a list or a dictionary then Jolokia has kindly deserialised the value.
+        # We will simple return it as a line fed string
+        if isinstance(value, (dict,list)):
+            return value.__str__()
+        else:
+            return value
+    
 class Jolokia_mbean_attribute(mbean_attribute):
             
-    def get_value(self):
-        return self.mbean.server.get_mbean_attribute_value(self.name, self.mbean)
+    def get_raw_value(self):
+        return self.mbean.server.get_mbean_attribute_raw_value(self.name, self.mbean)
+    
+    def get_raw_item_value(self, path):
+        return self.mbean.server.get_mbean_attribute_raw_item_value(self.name, self.mbean, path)
         
     def set_attribute(self, value):
         return self.mbean.server.set_mbean_attribute_value(self.name, value, self.mbean)
@@ -163,7 +258,8 @@ class mbean_operation(object):
     def get_description(self):
         return self.description
 
-    def invoke(self, parameters=None):
+    def invoke(self, args=None):
+        """ Invoke the operation with a list of argument values, one for each parameter """
         raise NotImplementedError()
     
     def get_paramters(self):
@@ -171,8 +267,8 @@ class mbean_operation(object):
 
 class Jolokia_mbean_operation(mbean_operation):
               
-    def invoke(self, parameters=None):
-        return self.mbean.server.invoke_mbean_operation(self.mbean, self.name, parameters)
+    def invoke(self, args=None):
+        return self.mbean.server.invoke_mbean_operation(self.mbean, self.name, self.params, args)
         
 class mbean_operation_parameter(object):
     """ An mbean operation parameter/arguments """ 
@@ -191,12 +287,6 @@ class mbean_operation_parameter(object):
     
     def get_description(self):
         return self.description
-    
-    def set_request_value(self, value):
-        self.request_value = value
-        
-    def get_request_value(self):
-        return self.request_value
 
 class mserver(object):
     """ Represents a connection to a JMX Servers"""
@@ -209,25 +299,126 @@ class mserver(object):
     def get_mbeans(self):
         raise NotImplementedError()
     
+    def search_mbean_names(self, if_modified_since=None):
+        """ Returns (names, timestamp). names is a list of the names of all mbeans, or None
+            if no mbean has been registered or unregistered since if_modified_since.
+            timestamp is to be passed as if_modified_since to the next call """
+        raise NotImplementedError()
+    
+    def read_attribute_pattern(self, pattern, name):
+        """ Returns a dict of object name to raw value of attribute name, for every mbean 
+            matching the object name pattern """
+        raise NotImplementedError()
+    
+    def mbeans_from_info(self, mbean_infos):
+        """ Returns mbeans for a dict of object name to info as JSON text, e.g. saved from 
+            an earlier get_mbeans_with_info(), without making any requests """
+        raise NotImplementedError()
+    
+    def mbeans_from_names(self, names):
+        """ Returns mbeans for a list of object names, e.g. from search_mbean_names(), 
+            without making any requests """
+        raise NotImplementedError()
+    
+    def read_attribute_values(self, reads):
+        """ Returns a dict of object name to a dict of attribute name to raw value, for a list 
+            of (object name, attribute names), read with as few requests as possible """
+        raise NotImplementedError()
+    
     def test(self):
         """Tests connectivity. Raises exception on error"""
         raise Mbean_Server_Exception(NotImplementedError())
 
 class Jolokia_server(mserver):
     
-    def __init__(self, server, port):
+    def __init__(self, server, port, pool_size=10, timeout=30, connect_timeout=5):
         mserver.__init__(self, server, port)
         self.url = "http://%s:%s/jolokia" % (self.server, self.port)
+        self.timeout = (connect_timeout, timeout)
+        
+        # One keep-alive session is shared by all fuse threads. Connections are pooled and
+        # reused, and a thread waits for a free connection rather than opening more than pool_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         
         self.test()
         
+    @stats.timed("http.get")
+    def _get(self, url, stream=False):
+        return self.session.get(url, timeout=self.timeout, stream=stream)
+    
+    @stats.timed("http.post")
+    def _post(self, url, data, stream=False):
+        return self.session.post(url, data, timeout=self.timeout, stream=stream)
+    
+    def _iter_list(self, url):
+        """ Yields (mbean name, info) for each mbean of a list response, decoding one mbean at 
+            a time as the response is read, so that a large response is never held whole """
+        r = self._get(url, stream=True)
+        try:
+            response_stream = jsonstream.response_stream(r)
+            error = None
+            for key in response_stream.iter_object():
+                if key != "value":
+                    value = response_stream.read_value()
+                    if key == "error":
+                        error = value
+                    continue
+                
+                for top_level_name in response_stream.iter_object():
+                    for sub_name in response_stream.iter_object():
+                        yield ("%s:%s" % (top_level_name, sub_name), response_stream.read_value())
+            if error:
+                raise Mbean_Server_Exception(error)
+        finally:
+            # Hands the connection back to the pool, or drops it if the list was left unfinished
+            r.close()
+        
+    @stats.timed("jolokia.get_mbeans")
     def get_mbeans(self):
-        r = requests.get("%s/list?maxDepth=2" % self.url)
-        json = get_json(r)
-        for (top_level_name, sub_names) in json["value"].items():
-            for sub_name in sub_names:
-                mbean_name = "%s:%s" % (top_level_name, sub_name)
-                yield Jolokia_mbean(mbean_name, self)
+        for (mbean_name, info) in self._iter_list("%s/list?maxDepth=2" % self.url):
+            yield Jolokia_mbean(mbean_name, self)
+                
+    @stats.timed("jolokia.search_mbean_names")
+    def search_mbean_names(self, if_modified_since=None):
+        url = "%s/search/*:*" % self.url
+        if if_modified_since:
+            url += "?ifModifiedSince=%d" % if_modified_since
+        r = self._get(url)
+        rjson = get_json(r)
+        
+        # Jolokia compares in whole seconds, so step back one second to not miss 
+        # changes made in the same second as this request
+        timestamp = rjson.get("timestamp")
+        if timestamp:
+            timestamp -= 1
+        
+        if rjson.get("status") == 304:
+            return (None, timestamp or if_modified_since)
+        if rjson.has_key("error"):
+            raise Mbean_Server_Exception(rjson["error"])
+        return (rjson["value"], timestamp)
+                
+    @stats.timed("jolokia.get_mbeans_with_info")
+    def get_mbeans_with_info(self):
+        """ Get all mbeans, including their attributes and operations, using a single list request.
+            Errors reading the info of an individual mbean are ignored by Jolokia and are
+            raised when the attributes or operations of that mbean are requested """
+        for (mbean_name, info) in self._iter_list("%s/list?ignoreErrors=true" % self.url):
+            yield Jolokia_mbean(mbean_name, self, info)
+                
+    def mbeans_from_info(self, mbean_infos):
+        return [Jolokia_mbean(mbean_name, self, info_json=info_json) for (mbean_name, info_json) in mbean_infos.items()]
+    
+    def mbeans_from_names(self, names):
+        return [Jolokia_mbean(mbean_name, self) for mbean_name in names]
+                
+    def check_mbean_info(self, info):
+        """ Raises an exception if Jolokia could not read the info of an mbean """
+        if info.has_key("error"):
+            raise Mbean_Server_Exception(info["error"])
                 
     def _split_mbean_name(self, mbean):
         """ Split mbean domain from name and returns parts as tuples"""
@@ -239,41 +430,144 @@ class Jolokia_server(mserver):
     def _escape_mbean_name(self, mbean_name):
         return mbean_name.replace("!", "!!").replace("/", "!/")
     
+    @stats.timed("jolokia.get_mbean_info")
+    def get_mbean_info(self, mbean):
+        """Get the attributes, operations, description and class name of mbean in one request"""
+        (mbean_domain, mbean_name) = self._split_mbean_name(mbean)
+        r = self._get("%s/list/%s/%s" % (self.url, self._escape_mbean_name(mbean_domain), self._escape_mbean_name(mbean_name)))
+        
+        rjson = get_json(r)
+        if rjson.has_key("error"):
+            raise Mbean_Server_Exception(rjson["error"])
+        return rjson["value"]
+    
+    @stats.timed("jolokia.get_mbean_attributes")
     def get_mbean_attributes(self, mbean):
         """Get mbean_attributes of mbean"""
         (mbean_domain, mbean_name) = self._split_mbean_name(mbean)
-        r = requests.get("%s/list/%s/%s/attr" % (self.url, self._escape_mbean_name(mbean_domain), self._escape_mbean_name(mbean_name)))
+        r = self._get("%s/list/%s/%s/attr" % (self.url, self._escape_mbean_name(mbean_domain), self._escape_mbean_name(mbean_name)))
         
         rjson = get_json(r)
-        for (attribute_name, attribute_details) in rjson["value"].items():
+        return self.parse_mbean_attributes(mbean, rjson["value"])
+    
+    def parse_mbean_attributes(self, mbean, attr_info):
+        """Get mbean_attributes of mbean from the "attr" section of a list response"""
+        for (attribute_name, attribute_details) in attr_info.items():
             writable = attribute_details["rw"]
-            yield Jolokia_mbean_attribute(attribute_name, mbean, read=True, write=writable)
+            yield Jolokia_mbean_attribute(attribute_name, mbean, read=True, write=writable,
+                                          type=attribute_details.get("type"))
             
-    def get_mbean_attribute_value(self, name, mbean):
+    @stats.timed("jolokia.get_mbean_attribute_raw_value")
+    def get_mbean_attribute_raw_value(self, name, mbean):
         mbean_name = mbean.name
-        r = requests.get("%s/read/%s/%s" % (self.url, self._escape_mbean_name(mbean_name), name))
-        value = get_json(r)["value"]
-        # If value is a list or a dictionary then Jolokia has kindly deserialised the value.
-        # We will simple return it as a line fed string
-        if isinstance(value, (dict,list)):
-            return value.__str__()
-        else:
-            return value
+        r = self._get("%s/read/%s/%s" % (self.url, self._escape_mbean_name(mbean_name), name))
+        return get_json(r)["value"]
+    
+    @stats.timed("jolokia.get_mbean_attribute_raw_item_value")
+    def get_mbean_attribute_raw_item_value(self, name, mbean, path):
+        """ Read only the item at path, a list of keys and list indexes, of a composite or tabular
+            attribute value, using Jolokia's inner path """
+        inner_path = "/".join(self._escape_mbean_name(unicode(element)) for element in path)
+        r = self._get("%s/read/%s/%s/%s" % (self.url, self._escape_mbean_name(mbean.name), 
+                                            self._escape_mbean_name(name), inner_path))
+        rjson = get_json(r)
+        if rjson.has_key("error"):
+            raise Mbean_Server_Exception(rjson["error"])
+        return rjson["value"]
         
+    @stats.timed("jolokia.get_mbean_attribute_values")
+    def get_mbean_attribute_values(self, mbean, names=None):
+        """ Read the named attributes of mbean, or all of them if names is None, in one request.
+            Returns a dict of attribute name to raw value. An attribute which could not be read 
+            has its error as its value, see is_error_value(), rather than failing the others """
+        request_obj = {"type": "read", "mbean": mbean.name, "config": {"ignoreErrors": True}}
+        if names is not None:
+            request_obj["attribute"] = names
+            
+        post_data_json = json.dumps(request_obj)
+        log.debug(post_data_json)
+        
+        r = self._post(self.url, post_data_json)
+        result_json = get_json(r)
+        
+        if result_json.has_key("error"):
+            raise Mbean_Server_Exception(result_json["error"])
+        
+        return result_json["value"]
+        
+    @stats.timed("jolokia.read_attribute_pattern")
+    def read_attribute_pattern(self, pattern, name):
+        """ Read attribute name of every mbean matching the object name pattern with one request.
+            Returns a dict of object name to raw value. Matching mbeans without the attribute are left out """
+        request_obj = {"type": "read", "mbean": pattern, "attribute": name}
+        post_data_json = json.dumps(request_obj)
+        log.debug(post_data_json)
+        
+        r = self._post(self.url, post_data_json)
+        result_json = get_json(r)
+        
+        if result_json.has_key("error"):
+            raise Mbean_Server_Exception(result_json["error"])
+        
+        if not is_object_name_pattern(pattern):
+            # Jolokia only nests the values by object name for patterns
+            return {pattern: result_json["value"]}
+        return dict((object_name, attributes[name]) for (object_name, attributes) in result_json["value"].items()
+                    if name in attributes)
+        
+    @stats.timed("jolokia.read_attribute_values")
+    def read_attribute_values(self, reads):
+        """ Read the attributes of several mbeans with one bulk request. reads is a list of 
+            (object name, attribute names). Returns a dict of object name to a dict of attribute 
+            name to raw value. mbeans which could not be read are left out, and attributes which
+            could not be read are left out of their mbean """
+        request_objs = [{"type": "read", "mbean": object_name, "attribute": list(names),
+                         "config": {"ignoreErrors": True}} for (object_name, names) in reads]
+        if not request_objs:
+            return {}
+        
+        post_data_json = json.dumps(request_objs)
+        log.debug(post_data_json)
+        
+        r = self._post(self.url, post_data_json, stream=True)
+        try:
+            # Decode the response of one mbean at a time as it is read
+            response_stream = jsonstream.response_stream(r)
+            if response_stream.peek() == "{":
+                # The whole bulk request failed
+                raise Mbean_Server_Exception(response_stream.read_value().get("error"))
+            
+            values = {}
+            for ((object_name, names), ignore) in izip(reads, response_stream.iter_array()):
+                response = response_stream.read_value()
+                if response.get("status") != 200:
+                    log.debug("Reading %s failed: %s", object_name, response.get("error"))
+                    continue
+                values[object_name] = dict((name, value) for (name, value) in response["value"].items() 
+                                           if name in names)
+            return values
+        finally:
+            r.close()
+        
+    @stats.timed("jolokia.get_mbean_operations")
     def get_mbean_operations(self, mbean):
+        (mbean_domain, mbean_name) = self._split_mbean_name(mbean)
+        r = self._get("%s/list/%s/%s/op" % (self.url, self._escape_mbean_name(mbean_domain),
+                                               self._escape_mbean_name(mbean_name)) )
+        
+        rjson = get_json(r)
+        return self.parse_mbean_operations(mbean, rjson["value"])
+    
+    def parse_mbean_operations(self, mbean, op_info):
+        """Get mbean_operations of mbean from the "op" section of a list response"""
         def get_params_from_args(arg_list):
             result = []
             for arg in arg_list:
-                param = mbean_operation_parameter(arg["type"], arg["name"], arg["desc"])
+                param = mbean_operation_parameter(arg["type"], None, name=arg["name"], description=arg["desc"])
                 result.append(param)
             return result
         
-        (mbean_domain, mbean_name) = self._split_mbean_name(mbean)
-        r = requests.get("%s/list/%s/%s/op" % (self.url, self._escape_mbean_name(mbean_domain),
-                                               self._escape_mbean_name(mbean_name)) )
-        
-        rjson = get_json(r)
-        for (op_name, op_item) in rjson["value"].items():
+        for (op_name, op_item) in op_info.items():
             
             if isinstance(op_item, dict):
                 # Just one signature        
@@ -287,6 +581,7 @@ class Jolokia_server(mserver):
                     yield Jolokia_mbean_operation(op_name, mbean, signature["ret"], signature["desc"], params)
             
          
+    @stats.timed("jolokia.set_mbean_attribute_value")
     def set_mbean_attribute_value(self, name, value, mbean):
         # TODO, change arg order to match invoke_ops 
         value = value.strip()
@@ -294,20 +589,22 @@ class Jolokia_server(mserver):
         post_data_json = json.dumps(post_data)
         log.debug(post_data_json)
         
-        r = requests.post(self.url, post_data_json)
+        r = self._post(self.url, post_data_json)
         
         result_json = get_json(r)
         if result_json.has_key("error"):
             raise Mbean_Attribute_Write_Exception(result_json["error"])
         return r
     
-    def invoke_mbean_operation(self, mbean, op_name, params):
+    @stats.timed("jolokia.invoke_mbean_operation")
+    def invoke_mbean_operation(self, mbean, op_name, params, args=None):
+        # The argument values are passed with each call, never stored on the shared parameters,
+        # so that concurrent invocations can't mix up their arguments
         sig_args = [] 
-        args = []
         if params:
             for param in params:
                 sig_args.append(param.get_type() )
-                args.append(param.get_request_value())
+        args = list(args or [])
             
         operation = "%s(%s)" % (op_name, ",".join(sig_args))
         
@@ -320,19 +617,19 @@ class Jolokia_server(mserver):
         post_data_json = json.dumps(request_obj)
         log.debug(post_data_json)
         
-        r = requests.post(self.url, post_data_json)       
+        r = self._post(self.url, post_data_json)       
         result_json = get_json(r)
         
         if result_json.has_key("error"):
             raise Mbean_Operation_Exec_Exception(result_json["error"])
         
         if result_json.has_key("value"):
-            log.debug("Value: %s" % result_json["value"])
+            log.debug("Value: %s", result_json["value"])
             return result_json["value"]
     
     def test(self):
         # Test connection
-        r = requests.get("%s" % self.url)
+        r = self._get("%s" % self.url)
         try:
             r.raise_for_status()
         except Exception, e:
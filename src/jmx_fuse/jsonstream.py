@@ -0,0 +1,115 @@
+"""
+    Incremental JSON decoding - Walks a JSON document as it is downloaded, so that large
+    responses are never held whole, as text or as decoded objects
+
+    @license: GPL
+    @copyright: Alastair McCormack
+    @author: Alastair McCormack
+    @contact: alastair@mcc-net.co.uk
+"""
+
+import json
+import codecs
+
+CHUNK_SIZE = 65536
+WHITESPACE = " \t\n\r"
+
+class json_stream(object):
+    """ Reads a JSON document from an iterator of UTF-8 chunks, e.g. response.iter_content().
+        Objects and arrays can be walked one member at a time with iter_object() and iter_array(),
+        and any value can be decoded whole with read_value(). Only the undecoded text of the
+        current member is buffered """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = u""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, wanted=1):
+        """ Read at least wanted more characters into the buffer, or up to the end of the 
+            document. Returns False if there was nothing more to read """
+        if self.eof:
+            return False
+        # Drop what has been read already
+        texts = [self.buffer[self.pos:]]
+        self.pos = 0
+        read = 0
+        for chunk in self.chunks:
+            text = self.utf8_decoder.decode(chunk)
+            texts.append(text)
+            read += len(text)
+            if read >= wanted:
+                break
+        else:
+            texts.append(self.utf8_decoder.decode("", True))
+            self.eof = True
+        self.buffer = u"".join(texts)
+        return read > 0 or not self.eof
+
+    def peek(self):
+        """ Returns the next character which isn't white space, without reading it """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, characters):
+        """ Read the next character, which must be one of characters """
+        character = self.peek()
+        if character not in characters:
+            raise ValueError("Expected one of %s but found %s at %s" % (characters, character, self.pos))
+        self.pos += 1
+        return character
+
+    def read_value(self):
+        """ Decode the next value whole """
+        self.peek()
+        while True:
+            try:
+                (value, end) = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # Most likely cut short by the end of the buffer. Read at least as much again 
+                # before retrying, so that large values aren't decoded over and over
+                if not self.fill(len(self.buffer) - self.pos):
+                    raise
+                continue
+            # A number at the end of the buffer may go on in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def iter_object(self):
+        """ Yields the key of each member of the next object. The caller must read the value
+            of the member, e.g. with read_value(), before asking for the next key """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def iter_array(self):
+        """ Yields once for each element of the next array. The caller must read the element """
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(",]") == "]":
+                return
+
+def response_stream(response, chunk_size=CHUNK_SIZE):
+    """ A json_stream of the body of a streamed requests response """
+    return json_stream(response.iter_content(chunk_size))
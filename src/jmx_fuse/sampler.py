@@ -0,0 +1,221 @@
+"""
+    Attribute sampler - Keeps a short history of attribute values in memory
+
+    @license: GPL
+    @copyright: Alastair McCormack
+    @author: Alastair McCormack
+    @contact: alastair@mcc-net.co.uk
+"""
+
+import logging
+import math
+import time
+import threading
+from array import array
+from datetime import datetime
+from fnmatch import fnmatchcase
+import jolokiaparser
+
+class NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+
+NAN = float("nan")
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+def numeric_samples(value):
+    """ Returns the numbers in an attribute value as a dict of key to number. A simple value
+        has the key None and a composite value a key for each numeric item. Returns None if 
+        there are no numbers """
+    if is_number(value):
+        return {None: value}
+    if isinstance(value, dict):
+        samples = dict((key, item) for (key, item) in value.items() if is_number(item))
+        if samples:
+            return samples
+    return None
+
+def format_sample(value):
+    # Whole numbers are shown without a decimal point
+    return "%.15g" % value
+
+class sample_ring(object):
+    """ The last size samples of an attribute. Timestamps and values are held in fixed size
+        arrays of doubles, which are overwritten oldest first. A composite value has one 
+        array of values for each of its numeric keys """
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array("d", [0.0]) * size
+        # Key -> array of values. Missing values are NaN
+        self.values = {}
+        # Number of samples ever added
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, timestamp, samples):
+        with self.lock:
+            position = self.count % self.size
+            self.times[position] = timestamp
+            for key in samples:
+                if key not in self.values:
+                    self.values[key] = array("d", [NAN]) * self.size
+            for (key, column) in self.values.items():
+                column[position] = float(samples.get(key, NAN))
+            self.count += 1
+
+    def get_samples(self):
+        """ Returns a list of (timestamp, dict of key to value), oldest first """
+        samples = []
+        with self.lock:
+            for index in xrange(max(0, self.count - self.size), self.count):
+                position = index % self.size
+                values = dict((key, column[position]) for (key, column) in self.values.items()
+                              if not math.isnan(column[position]))
+                samples.append( (self.times[position], values) )
+        return samples
+
+    def get_contents(self):
+        """ One line per sample, oldest first: the time followed by the value, or by key=value
+            for each numeric item of a composite value """
+        lines = []
+        for (timestamp, values) in self.get_samples():
+            if None in values:
+                sample = format_sample(values[None])
+            else:
+                sample = " ".join("%s=%s" % (key, format_sample(values[key])) for key in sorted(values))
+            lines.append("%s %s\n" % (datetime.fromtimestamp(timestamp).isoformat(), sample))
+        return "".join(lines)
+
+class attribute_sampler(object):
+    """ Every interval, reads the attributes matching a set of object name and attribute 
+        globs with one bulk request, and keeps the last size numeric values of each """
+
+    def __init__(self, tree_manager, interval=10, size=60):
+        self.tree_manager = tree_manager
+        self.interval = interval
+        self.size = size
+        # List of (object name pattern, attribute name glob)
+        self.rules = []
+        # (object name, attribute name) -> sample_ring
+        self.histories = {}
+        self.thread = None
+
+    def add_rule(self, object_name_glob, attribute_glob):
+        # A glob without a ":" is a domain and matches all of its mbeans
+        if ":" not in object_name_glob:
+            object_name_glob += ":*"
+        self.rules.append( (object_name_glob, attribute_glob) )
+
+    def load(self, sample_file_name):
+        """ Read rules from a file. Each line holds an object name or domain glob and an 
+            attribute name glob, separated by white space, e.g.
+
+            java.lang:type=Memory                       HeapMemoryUsage
+            java.lang:type=GarbageCollector,*           Collection*
+
+            Object names may contain spaces. Lines starting with # are ignored """
+        sample_file = open(sample_file_name)
+        try:
+            for (line_no, line) in enumerate(sample_file):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+
+                rule = line.rsplit(None, 1)
+                if len(rule) != 2:
+                    raise ValueError("%s line %s: expected object name and attribute" %
+                                     (sample_file_name, line_no + 1))
+                self.add_rule(rule[0], rule[1])
+        finally:
+            sample_file.close()
+
+    def get_sampled_attributes(self, mbean):
+        """ Returns the names of the attributes of mbean which are sampled """
+        attribute_globs = self.__get_attribute_globs(mbean.get_object_name())
+        if not attribute_globs:
+            return []
+        return [attribute.get_name() for attribute in mbean.get_attributes()
+                if any(fnmatchcase(attribute.get_name(), glob) for glob in attribute_globs)]
+
+    def get_history(self, object_name, attribute_name):
+        return self.histories.get( (object_name, attribute_name) )
+
+    def __get_attribute_globs(self, object_name):
+        return [attribute_glob for (object_name_glob, attribute_glob) in self.rules
+                if jolokiaparser.object_name_matches(object_name_glob, object_name)]
+
+    def get_targets(self):
+        """ Returns a list of (object name, attribute names) to sample, from the mbeans in the tree """
+        targets = []
+        for mbean in self.tree_manager.get_mbeans():
+            object_name = mbean.get_object_name()
+            attribute_globs = self.__get_attribute_globs(object_name)
+            if not attribute_globs:
+                continue
+
+            if any(set("*?[") & set(glob) for glob in attribute_globs):
+                # Only the info of the mbean can tell which attributes match
+                try:
+                    names = self.get_sampled_attributes(mbean)
+                except Exception:
+                    log.debug("Getting attributes of %s failed", object_name, exc_info=True)
+                    continue
+            else:
+                names = attribute_globs
+
+            if names:
+                targets.append( (object_name, names) )
+        return targets
+
+    def sample(self):
+        """ Take one sample of every matching attribute """
+        targets = self.get_targets()
+        if not targets:
+            return
+
+        timestamp = time.time()
+        values = self.tree_manager.mbean_server.read_attribute_values(targets)
+
+        histories = {}
+        for (object_name, names) in targets:
+            mbean_values = values.get(object_name, {})
+            for name in names:
+                key = (object_name, name)
+                history = self.histories.get(key)
+                if name in mbean_values and not jolokiaparser.is_error_value(mbean_values[name]):
+                    # Fresh values may as well serve reads too
+                    self.tree_manager.value_cache.put(object_name, name, mbean_values[name])
+                    samples = numeric_samples(mbean_values[name])
+                    if samples:
+                        if not history:
+                            history = sample_ring(self.size)
+                        history.add(timestamp, samples)
+                if history:
+                    histories[key] = history
+        # Histories of attributes which are no longer sampled are dropped
+        self.histories = histories
+
+    def start(self):
+        """ Start sampling in a background thread """
+        if self.thread or not self.rules:
+            return
+        mbean_server = self.tree_manager.mbean_server
+        self.thread = threading.Thread(target=self.__run,
+                                       name="jmxfuse-sampler-%s:%s" % (mbean_server.server, mbean_server.port))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __run(self):
+        while True:
+            started = time.time()
+            try:
+                self.sample()
+            except Exception:
+                log.exception("Sampling attributes failed")
+            time.sleep(max(0, self.interval - (time.time() - started)))
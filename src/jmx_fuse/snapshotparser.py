@@ -0,0 +1,268 @@
+'''
+    A snapshot connector. Serves the mbeans, attribute values and operations of a JMX server,
+    captured once to a single file, without connecting to anything.
+
+    A snapshot file holds:
+        header      magic, then the offset and length of each section
+        meta        JSON: the host and port captured and when
+        records     one zlib compressed JSON record per mbean: its Jolokia info and attribute values
+        names       the UTF-8 object names of all mbeans
+        index       one (name offset, name length, record offset, record length) entry per mbean,
+                    sorted by name
+
+    The file is memory mapped. Opening it only reads the header, and records are only
+    decompressed when their mbean is used, so mounting a large snapshot is quick.
+
+    @license: GPL3
+    @copyright: Alastair McCormack
+    @author: Alastair McCormack
+    @contact: alastair@mcc-net.co.uk
+
+'''
+
+import os
+import mmap
+import json
+import time
+import zlib
+import struct
+import logging
+import stats
+from jolokiaparser import mserver, Jolokia_server, Jolokia_mbean, Jolokia_mbean_attribute, is_object_name_pattern, \
+    object_name_matches, Mbean_Server_Exception, Mbean_Attribute_Write_Exception, Mbean_Operation_Exec_Exception
+
+MAGIC = "JMXSNAP\x01"
+# index offset, mbean count, names offset, meta offset, meta length
+HEADER = struct.Struct("<QIQQI")
+# name offset, name length, record offset, record length
+INDEX_ENTRY = struct.Struct("<QIQI")
+
+class NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+
+@stats.timed("snapshot.capture")
+def capture(mbean_server, file_name, batch_size=500):
+    """ Write the info and readable attribute values of every mbean of mbean_server to a snapshot
+        file. Values are read batch_size mbeans at a time. Returns the number of mbeans captured """
+    mbeans = sorted(mbean_server.get_mbeans_with_info(), key=lambda mbean: mbean.get_object_name().encode("utf-8"))
+
+    values = {}
+    for start in range(0, len(mbeans), batch_size):
+        reads = []
+        for mbean in mbeans[start:start + batch_size]:
+            attribute_names = mbean.info.get("attr", {}).keys()
+            if attribute_names and not mbean.info.has_key("error"):
+                reads.append( (mbean.get_object_name(), attribute_names) )
+        values.update(mbean_server.read_attribute_values(reads))
+
+    meta = json.dumps({"host": mbean_server.server, "port": mbean_server.port, "captured": time.time()})
+
+    temp_file_name = file_name + ".tmp"
+    snapshot_file = open(temp_file_name, "wb")
+    try:
+        snapshot_file.write(MAGIC)
+        snapshot_file.write(HEADER.pack(0, 0, 0, 0, 0))
+        meta_offset = snapshot_file.tell()
+        snapshot_file.write(meta)
+
+        records = []
+        for mbean in mbeans:
+            object_name = mbean.get_object_name()
+            record = zlib.compress(json.dumps({"info": mbean.info, "values": values.get(object_name, {})}))
+            records.append( (snapshot_file.tell(), len(record)) )
+            snapshot_file.write(record)
+
+        names_offset = snapshot_file.tell()
+        names = []
+        name_offset = 0
+        for mbean in mbeans:
+            name = mbean.get_object_name().encode("utf-8")
+            names.append( (name_offset, len(name)) )
+            name_offset += len(name)
+            snapshot_file.write(name)
+
+        index_offset = snapshot_file.tell()
+        for ((name_offset, name_length), (record_offset, record_length)) in zip(names, records):
+            snapshot_file.write(INDEX_ENTRY.pack(name_offset, name_length, record_offset, record_length))
+
+        snapshot_file.seek(len(MAGIC))
+        snapshot_file.write(HEADER.pack(index_offset, len(mbeans), names_offset, meta_offset, len(meta)))
+    finally:
+        snapshot_file.close()
+    # Readers never see a half written snapshot
+    os.rename(temp_file_name, file_name)
+    return len(mbeans)
+
+class Snapshot_mbean(Jolokia_mbean):
+    """ An mbean of a snapshot. Its record is read from the snapshot the first time it is used """
+
+    def __init__(self, name, server, index, info=None):
+        Jolokia_mbean.__init__(self, name, server, info)
+        self.index = index
+        self.record = None
+
+    def get_record(self):
+        if self.record is None:
+            self.record = self.server.read_record(self.index)
+        return self.record
+
+class Snapshot_server(Jolokia_server):
+    """ Serves a snapshot file written by capture(). The host is the name of the file.
+        Attributes are read only and operations can't be invoked """
+
+    def __init__(self, server, port, **kw):
+        self.file_name = server
+        # The host is used as a directory name when several servers are mounted
+        mserver.__init__(self, os.path.basename(server), port)
+
+        snapshot_file = open(self.file_name, "rb")
+        try:
+            self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            snapshot_file.close()
+
+        self.test()
+        (self.index_offset, self.count, self.names_offset, meta_offset, meta_length) = \
+            HEADER.unpack_from(self.map, len(MAGIC))
+        self.meta = json.loads(self.map[meta_offset:meta_offset + meta_length])
+
+    def get_index_entry(self, index):
+        return INDEX_ENTRY.unpack_from(self.map, self.index_offset + index * INDEX_ENTRY.size)
+
+    def get_index_name(self, index):
+        (name_offset, name_length, record_offset, record_length) = self.get_index_entry(index)
+        name_offset += self.names_offset
+        return self.map[name_offset:name_offset + name_length]
+
+    def find_index(self, object_name):
+        """ Binary search of the index. Returns the index of object_name or None """
+        name = object_name.encode("utf-8")
+        (low, high) = (0, self.count)
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_index_name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.get_index_name(low) == name:
+            return low
+        return None
+
+    @stats.timed("snapshot.read_record")
+    def read_record(self, index):
+        (name_offset, name_length, record_offset, record_length) = self.get_index_entry(index)
+        return json.loads(zlib.decompress(self.map[record_offset:record_offset + record_length]))
+
+    def get_mbean(self, object_name):
+        index = self.find_index(object_name)
+        if index is None:
+            raise Mbean_Server_Exception("javax.management.InstanceNotFoundException : %s" % object_name)
+        return Snapshot_mbean(object_name, self, index)
+
+    def get_mbean_names(self):
+        # Unpack the whole index and copy the names section in one go each, rather than per mbean
+        names = self.map[self.names_offset:self.index_offset]
+        entries = struct.unpack_from("<" + INDEX_ENTRY.format.lstrip("<") * self.count, self.map, self.index_offset)
+        return [names[entries[entry]:entries[entry] + entries[entry + 1]].decode("utf-8")
+                for entry in xrange(0, len(entries), 4)]
+
+    @stats.timed("snapshot.get_mbeans")
+    def get_mbeans(self):
+        return [Snapshot_mbean(name, self, index) for (index, name) in enumerate(self.get_mbean_names())]
+
+    def search_mbean_names(self, if_modified_since=None):
+        # A snapshot never changes
+        if if_modified_since:
+            return (None, if_modified_since)
+        return (self.get_mbean_names(), int(self.meta["captured"]))
+
+    def get_mbeans_with_info(self):
+        mbeans = self.get_mbeans()
+        for mbean in mbeans:
+            mbean.info = mbean.get_record()["info"]
+        return mbeans
+
+    def mbeans_from_info(self, mbean_infos):
+        # The snapshot holds the info itself
+        return self.mbeans_from_names(mbean_infos)
+
+    def mbeans_from_names(self, names):
+        mbeans = []
+        for mbean_name in names:
+            index = self.find_index(mbean_name)
+            if index is not None:
+                mbeans.append(Snapshot_mbean(mbean_name, self, index))
+        return mbeans
+
+    def get_mbean_info(self, mbean):
+        return mbean.get_record()["info"]
+
+    def get_mbean_attributes(self, mbean):
+        return self.parse_mbean_attributes(mbean, self.get_mbean_info(mbean).get("attr", {}))
+
+    def get_mbean_operations(self, mbean):
+        return self.parse_mbean_operations(mbean, self.get_mbean_info(mbean).get("op", {}))
+
+    def parse_mbean_attributes(self, mbean, attr_info):
+        for (attribute_name, attribute_details) in attr_info.items():
+            yield Jolokia_mbean_attribute(attribute_name, mbean, read=True, write=False,
+                                          type=attribute_details.get("type"))
+
+    def get_mbean_attribute_raw_value(self, name, mbean):
+        values = mbean.get_record()["values"]
+        if not values.has_key(name):
+            raise Mbean_Server_Exception("%s of %s was not captured" % (name, mbean.name))
+        return values[name]
+
+    def get_mbean_attribute_raw_item_value(self, name, mbean, path):
+        value = self.get_mbean_attribute_raw_value(name, mbean)
+        try:
+            for element in path:
+                if isinstance(value, list):
+                    element = int(element)
+                value = value[element]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise Mbean_Server_Exception("%s of %s has no item %s" % (name, mbean.name, "/".join(map(unicode, path))))
+        return value
+
+    def get_mbean_attribute_values(self, mbean, names=None):
+        values = mbean.get_record()["values"]
+        if names is None:
+            return dict(values)
+        return dict((name, values[name]) for name in names if values.has_key(name))
+
+    def read_attribute_pattern(self, pattern, name):
+        if not is_object_name_pattern(pattern):
+            return {pattern: self.get_mbean_attribute_raw_value(name, self.get_mbean(pattern))}
+
+        values = {}
+        for mbean in self.get_mbeans():
+            if object_name_matches(pattern, mbean.name):
+                mbean_values = mbean.get_record()["values"]
+                if mbean_values.has_key(name):
+                    values[mbean.name] = mbean_values[name]
+        return values
+
+    def read_attribute_values(self, reads):
+        values = {}
+        for (object_name, names) in reads:
+            index = self.find_index(object_name)
+            if index is None:
+                continue
+            values[object_name] = self.get_mbean_attribute_values(Snapshot_mbean(object_name, self, index), names)
+        return values
+
+    def set_mbean_attribute_value(self, name, value, mbean):
+        raise Mbean_Attribute_Write_Exception("%s is a snapshot and can't be written to" % self.file_name)
+
+    def invoke_mbean_operation(self, mbean, op_name, params, args=None):
+        raise Mbean_Operation_Exec_Exception("%s is a snapshot. Operations can't be invoked" % self.file_name)
+
+    def test(self):
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise Mbean_Server_Exception("%s is not a jmxfuse snapshot" % self.file_name)
+        return True
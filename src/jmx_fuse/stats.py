@@ -0,0 +1,117 @@
+"""
+    Statistics - Call counts, error counts and latency histograms, cheap enough to be
+    kept for every request
+
+    @license: GPL
+    @copyright: Alastair McCormack
+    @author: Alastair McCormack
+    @contact: alastair@mcc-net.co.uk
+"""
+
+import time
+import inspect
+import functools
+import threading
+from array import array
+
+# Latencies are counted in power of two buckets of microseconds. Bucket n counts the 
+# calls which took less than 2**n microseconds, and at least half that
+BUCKETS = 32
+
+class call_stats(object):
+    """ Number of calls, errors and a latency histogram of one kind of call """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = array("L", [0]) * BUCKETS
+        self.lock = threading.Lock()
+
+    def record(self, seconds, error=False):
+        bucket = min(int(seconds * 1000000).bit_length(), BUCKETS - 1)
+        with self.lock:
+            self.count += 1
+            if error:
+                self.errors += 1
+            self.total_time += seconds
+            if seconds > self.max_time:
+                self.max_time = seconds
+            self.histogram[bucket] += 1
+
+    def get_histogram(self):
+        """ Returns a list of (upper bound in seconds, number of calls) for each bucket """
+        with self.lock:
+            counts = list(self.histogram)
+        return [(2 ** bucket / 1000000.0, count) for (bucket, count) in enumerate(counts)]
+
+    def get_percentile(self, fraction):
+        """ Returns the upper bound, in seconds, of the latency of fraction of the calls. No
+            more than the slowest call, which may be well below the upper bound of its bucket """
+        histogram = self.get_histogram()
+        threshold = fraction * sum(count for (upper_bound, count) in histogram)
+        seen = 0
+        for (upper_bound, count) in histogram:
+            seen += count
+            if count and seen >= threshold:
+                return min(upper_bound, self.max_time)
+        return 0.0
+
+class stats_registry(object):
+    """ The call_stats of every kind of call, by name """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def get_call_stats(self, name):
+        call = self.calls.get(name)
+        if call is None:
+            with self.lock:
+                call = self.calls.setdefault(name, call_stats(name))
+        return call
+
+    def get_all_call_stats(self):
+        """ Returns the call_stats of the kinds of call which have been made, sorted by name """
+        return sorted([call for call in self.calls.values() if call.count], key=lambda call: call.name)
+
+registry = stats_registry()
+
+def timed(name):
+    """ Decorator which records the calls of a function as name. Raising an exception or 
+        returning a negative errno counts as an error. For a generator function the time 
+        taken to run through the generator is recorded """
+    call = registry.get_call_stats(name)
+
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kw):
+                started = time.time()
+                error = True
+                try:
+                    for item in function(*args, **kw):
+                        yield item
+                    error = False
+                except GeneratorExit:
+                    # The caller stopped early
+                    error = False
+                    raise
+                finally:
+                    call.record(time.time() - started, error)
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kw):
+            started = time.time()
+            error = True
+            try:
+                result = function(*args, **kw)
+                error = isinstance(result, int) and result < 0
+                return result
+            finally:
+                call.record(time.time() - started, error)
+        return wrapper
+    return decorator
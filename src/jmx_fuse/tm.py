@@ -9,91 +9,554 @@
 
 import logging
 import fs
+import cache
+import sampler
+import jolokiaparser
+import stats
 from datetime import datetime, timedelta
 import re
 import sys
+import json
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
 
-class jmx_tree_manager:
-    root_dir = None
-    mbean_server = None
-    rescan_interval = None
-    rescan_timedelta = None
-    last_build_time = None
-    
-    @classmethod
-    def init(cls, mbean_server, rescan):
-        cls.mbean_server = mbean_server
-        cls.set_rescan(rescan)
-    
-    @classmethod
-    def set_rescan(cls, time_r):
+class jmx_tree_manager(object):
+    """ Holds the tree of a single mbean server. 
+        Safe to use from several threads: the tree is only changed by builds, which are
+        serialised, and each change is a single atomic attach or detach of a node """
+    
+    def __init__(self, mbean_server, rescan, metadata="lazy", cache_ttl="1s", cache_policy=None, cache_size=10000,
+                 metadata_workers=8, sample=None, sample_interval="10s", sample_size=60,
+                 invoke="sync", invoke_workers=4, results_count=100, results_bytes=1048576, metadata_cache=None):
+        self.mbean_server = mbean_server
+        self.root_dir = None
+        self.rescan_interval = None
+        self.rescan_timedelta = None
+        self.last_build_time = None
+        # "lazy" fetches the info of each mbean when its directory is first used,
+        # "full" fetches the info of all mbeans in one request when the tree is built,
+        # "parallel" fetches the info of each mbean, metadata_workers at a time, when the tree is built
+        self.metadata = metadata
+        self.metadata_workers = metadata_workers
+        # Background rebuilding of the tree
+        self.build_lock = threading.Lock()
+        self.refresher = None
+        self.rescan_event = threading.Event()
+        self.rescan_requested = False
+        # mbean_directory of each object name in the tree
+        self.mbean_dirs = {}
+        # Nodes added to the root of every tree, e.g. .stats
+        self.root_children = []
+        # State of the cheap check for mbean changes, as of the last successful build
+        self.change_check_time = None
+        self.mbean_names_fingerprint = None
+        
+        # Info of every mbean kept on disk between mounts. The first tree is built from it, 
+        # if it belongs to the running JVM, and is then checked against the server in the background.
+        # Stale until the info of every mbean has been fetched from the server and saved
+        self.metadata_cache = None
+        self.metadata_cache_stale = False
+        if metadata_cache:
+            self.metadata_cache = cache.metadata_cache(metadata_cache)
+            self.metadata_cache_stale = True
+        
+        self.set_rescan(rescan)
+        
+        # Recently read attribute values
+        policy = cache.ttl_policy(cache.parse_ttl(cache_ttl))
+        if cache_policy:
+            policy.load(cache_policy)
+        self.value_cache = cache.value_cache(policy, cache_size)
+        
+        # "sync" invokes operations in the writing thread, "async" queues them for invoke_workers threads
+        self.invoke = invoke
+        self.invoke_workers = invoke_workers
+        self.invoke_pool = None
+        self.invoke_pool_lock = threading.Lock()
+        # Limits of the results and errors kept for each operation
+        self.results_count = results_count
+        self.results_bytes = results_bytes
+        
+        # Short histories of the attributes listed in the sample file
+        self.sampler = None
+        if sample:
+            self.sampler = sampler.attribute_sampler(self, cache.parse_ttl(sample_interval), sample_size)
+            self.sampler.load(sample)
+    
+    def set_rescan(self, time_r):
         """ Sets rescan interval by time, using prepended m or s to specify seconds or minutes.
             Defaults to seconds if no modifier given
         """
         
-        logging.debug("Setting rescan interval to: %s" % time_r)
+        logging.debug("Setting rescan interval to: %s", time_r)
         time_format_match = re.match("(\d+)\s*([ms]?)", time_r, re.IGNORECASE)
         if time_format_match:
             logging.debug("String matched regex")
             new_rescan = int(time_format_match.group(1))
-            logging.debug("new_rescan %s" % new_rescan)
+            logging.debug("new_rescan %s", new_rescan)
             time_format_mod = time_format_match.group(2)
-            logging.debug("time_format_mod: %s" % time_format_mod)
+            logging.debug("time_format_mod: %s", time_format_mod)
             
             
             if time_format_mod == "m":
-                cls.rescan_timedelta = timedelta(minutes = new_rescan)
-                cls.rescan_interval = "%sm" % new_rescan
+                self.rescan_timedelta = timedelta(minutes = new_rescan)
+                self.rescan_interval = "%sm" % new_rescan
             else:
-                cls.rescan_timedelta = timedelta(seconds = new_rescan)
-                cls.rescan_interval = "%ss" % new_rescan
+                self.rescan_timedelta = timedelta(seconds = new_rescan)
+                self.rescan_interval = "%ss" % new_rescan
                 
-            logging.debug("Set rescan_timedelta to %s" % cls.rescan_timedelta)
+            logging.debug("Set rescan_timedelta to %s", self.rescan_timedelta)
+            # Let the refresher pick up the new interval
+            self.rescan_event.set()
             
-    @classmethod
-    def rebuild_on_next_request(cls):
-        logging.debug("Clearing root_dir ready for rebuild")
-        cls.root_dir = None
-        logging.debug("Root dir: %s" % cls.root_dir)
-    
-    @classmethod
-    def build_tree(cls):
-        # build dir tree
-        logging.debug("Building tree")
-        cls.root_dir = fs.root_directory()
+    def request_rescan(self):
+        """ Ask the refresher to rebuild the tree now, even if no mbean has changed """
+        logging.debug("Requesting rebuild of tree")
+        self.rescan_requested = True
+        self.rescan_event.set()
+        
+    def start_refresher(self):
+        """ Start a background thread which rebuilds the tree every rescan interval, 
+            or when requested, so that requests never wait for a rescan """
+        if self.refresher:
+            return
+        self.refresher = threading.Thread(target=self.__refresh_loop, 
+                                          name="jmxfuse-refresher-%s:%s" % (self.mbean_server.server, self.mbean_server.port))
+        self.refresher.daemon = True
+        self.refresher.start()
+        
+    def submit_invocation(self, invocation):
+        """ Call invocation on the pool of invoke workers """
+        with self.invoke_pool_lock:
+            if not self.invoke_pool:
+                # Created on first use, as its threads must be started after fuse has daemonised
+                self.invoke_pool = ThreadPool(self.invoke_workers)
+        self.invoke_pool.apply_async(invocation)
         
-        connection_info_file = fs.file("connection_info")
-        connection_info_file.set_contents("%s:%s" % (cls.mbean_server.server, cls.mbean_server.port))       
-        cls.root_dir.add_child(connection_info_file)
+    def start_sampler(self):
+        if self.sampler:
+            self.sampler.start()
+        
+    def __refresh_loop(self):
+        while True:
+            if self.last_build_time and not self.rescan_requested:
+                next_build_time = self.last_build_time + self.rescan_timedelta
+                timeout = (next_build_time - datetime.now()).total_seconds()
+                if timeout > 0:
+                    self.rescan_event.wait(timeout)
+                    self.rescan_event.clear()
+                    continue
+            
+            force = self.rescan_requested
+            self.rescan_requested = False
+            try:
+                self.build_tree(force)
+            except Exception:
+                logging.exception("Rebuilding tree failed")
+    
+    def build_tree(self, force=False):
+        """ Bring the tree up to date. Unless force is set, the tree is left as it is 
+            when the server reports that no mbean has been registered or unregistered """
+        with self.build_lock:
+            self.__build_tree(force)
+            
+    def __check_for_changes(self):
+        """ Cheaply check whether any mbean has been registered or unregistered since the
+            tree was last brought up to date. Asks the server (Jolokia's ifModifiedSince)
+            and, failing that, compares a fingerprint of all mbean names.
+            Returns (changed, change_check_time, mbean_names_fingerprint, mbean_names). 
+            mbean_names is None unless the server sent them """
+        try:
+            (names, check_time) = self.mbean_server.search_mbean_names(self.change_check_time)
+        except Exception:
+            logging.debug("Checking for mbean changes failed", exc_info=True)
+            return (True, None, None, None)
+        
+        if names is None:
+            return (False, check_time, self.mbean_names_fingerprint, None)
+        
+        fingerprint = hashlib.sha1(u"\n".join(sorted(names)).encode("utf-8")).hexdigest()
+        return (fingerprint != self.mbean_names_fingerprint, check_time, fingerprint, names)
+            
+    @stats.timed("tree.build")
+    def __build_tree(self, force=False):
+        """ Bring the tree up to date with the mbeans of the server.
+            The first tree is built off to the side and then swapped in as root_dir. 
+            Later rescans only add the mbeans which are new and prune those which have gone,
+            so that the nodes of all other mbeans, and what they have cached, are kept """
+        cached_mbeans = None
+        if not self.root_dir and self.metadata_cache:
+            cached_mbeans = self.__load_metadata_cache()
+        
+        if cached_mbeans is not None:
+            # Skip the check, so that the first rescan compares the cached mbeans with the server
+            (changed, check_time, fingerprint, names) = (True, None, None, None)
+        else:
+            (changed, check_time, fingerprint, names) = self.__check_for_changes()
+        if self.root_dir and not changed and not force:
+            logging.debug("No mbeans registered or unregistered. Keeping tree")
+            self.change_check_time = check_time
+            self.last_build_time = datetime.now()
+            return
         
-        connection_info_file = fs.file_rescan_interval("rescan")        
-        cls.root_dir.add_child(connection_info_file)
+        logging.debug("Building tree")
+        root_dir = self.root_dir
+        if not root_dir:
+            root_dir = self.__new_root_directory()
         
+        # Refresh the metadata cache in the background, never while the first tree is waited for
+        fetch_info = self.metadata == "full" or (self.metadata_cache_stale and self.root_dir is not None)
         try:
-            for mbean in cls.mbean_server.get_mbeans():
-                mbean_name = mbean.get_name_array()
-                parent = cls.root_dir
+            if cached_mbeans is not None:
+                mbeans = cached_mbeans
+            elif fetch_info:
+                # Fetch the names and info of every mbean in one request
+                mbeans = self.mbean_server.get_mbeans_with_info()
+            elif names is not None:
+                # The check has already fetched the names. mbean_directory fetches the rest on demand
+                mbeans = self.mbean_server.mbeans_from_names(names)
+            else:
+                # Fetch names only. mbean_directory fetches the rest on demand
+                mbeans = self.mbean_server.get_mbeans()
                 
-                # Get all but the last elements of the mbean name
-                for mbean_name_element in mbean_name[:-1]:
-                    #logging.debug("Adding %s to parent %s" % (mbean_name_element, parent.get_name()))
-                    new_parent = parent.add_directory(mbean_name_element)
-                    parent = new_parent
-                # Get the last part of the element name
-                mbean_dir = fs.mbean_directory(mbean_name[-1], mbean)
-                parent.add_child(mbean_dir)
+            current_mbeans = {}
+            for mbean in mbeans:
+                current_mbeans[mbean.get_object_name()] = mbean
         except:
             msg = "%s - %s" % sys.exc_info()[0:2]
             logging.error(msg)
+            self.last_build_time = datetime.now()
+            if self.root_dir:
+                # Keep serving the last complete tree
+                return
             error_file = fs.file("error")
             error_file.set_contents(msg)
-            cls.root_dir.add_child(error_file)
+            root_dir.add_child(error_file)
+            self.root_dir = root_dir
+            return
+        
+        removed = [name for name in self.mbean_dirs if name not in current_mbeans]
+        added = [name for name in current_mbeans if name not in self.mbean_dirs]
+        if fetch_info:
+            # mbeans whose attributes or operations have changed since their directory was made, 
+            # e.g. since the metadata cache was saved, are replaced
+            for name in current_mbeans:
+                mbean_dir = self.mbean_dirs.get(name)
+                if not mbean_dir:
+                    continue
+                if mbean_dir.mbean.info is None:
+                    mbean_dir.mbean.info = current_mbeans[name].info
+                elif mbean_dir.mbean.info != current_mbeans[name].info:
+                    added.append(name)
+        logging.debug("%s mbeans added or changed, %s removed", len(added), len(removed))
+        
+        if self.metadata == "parallel":
+            self.__fetch_mbean_info([current_mbeans[name] for name in added])
+        
+        # An mbean which can't be added or removed, e.g. one whose name can't be split into 
+        # directories, is skipped rather than failing the whole build
+        errors = []
+        for name in removed:
+            try:
+                self.__remove_mbean_directory(root_dir, self.mbean_dirs.pop(name))
+            except Exception:
+                errors.append("Removing %s failed: %s - %s" % ((name,) + sys.exc_info()[0:2]))
+        for name in added:
+            try:
+                self.mbean_dirs[name] = self.__add_mbean_directory(root_dir, current_mbeans[name])
+            except Exception:
+                errors.append("Adding %s failed: %s - %s" % ((name,) + sys.exc_info()[0:2]))
+        
+        # Clear the error of an earlier build
+        root_dir.remove_child("error")
+        if errors:
+            for error in errors:
+                logging.error(error)
+            error_file = fs.file("error")
+            error_file.set_contents("\n".join(errors))
+            root_dir.add_child(error_file)
+        
+        # Assignment is atomic. Requests walk whichever tree they started with
+        self.root_dir = root_dir
+        self.last_build_time = datetime.now()
+        self.change_check_time = check_time
+        self.mbean_names_fingerprint = fingerprint
+        
+        if self.metadata_cache_stale:
+            if fetch_info:
+                self.__save_metadata_cache(current_mbeans)
+            else:
+                # Fetch the info of every mbean and check the cached mbeans in the background
+                self.request_rescan()
+        
+    def __get_start_time(self):
+        """ Returns the start time of the JVM, which tells one run of it from another, or None """
+        try:
+            return self.mbean_server.read_attribute_pattern("java.lang:type=Runtime", "StartTime").get("java.lang:type=Runtime")
+        except Exception:
+            logging.debug("Reading the start time of the JVM failed", exc_info=True)
+            return None
+        
+    def __load_metadata_cache(self):
+        """ Returns the mbeans saved in the metadata cache for this run of the JVM, or None """
+        start_time = self.__get_start_time()
+        if start_time is None:
+            return None
+        mbean_infos = self.metadata_cache.load(self.mbean_server.server, self.mbean_server.port, start_time)
+        if mbean_infos is None:
+            return None
+        logging.info("Building tree of %s mbeans from the metadata cache", len(mbean_infos))
+        return self.mbean_server.mbeans_from_info(mbean_infos)
+    
+    def __save_metadata_cache(self, mbeans):
+        start_time = self.__get_start_time()
+        if start_time is None:
+            # Without it a later mount couldn't tell whether the cache is of the same JVM
+            logging.warning("Not saving the metadata cache of %s, as the start time of the JVM is unknown", self.get_name())
+            self.metadata_cache_stale = False
+            return
+        try:
+            self.metadata_cache.save(self.mbean_server.server, self.mbean_server.port, start_time,
+                                     dict((name, json.dumps(mbean.info)) for (name, mbean) in mbeans.items()))
+            self.metadata_cache_stale = False
+        except Exception:
+            logging.exception("Saving the metadata cache failed")
+        
+    def __fetch_mbean_info(self, mbeans):
+        """ Fetch the attributes and operations of mbeans concurrently, using a bounded pool of workers """
+        if not mbeans:
+            return
+        
+        def fetch(mbean):
+            try:
+                mbean.get_attributes()
+                mbean.get_operations()
+            except Exception:
+                # The mbean's directory will fetch again and show the error
+                logging.debug("Fetching info of %s failed", mbean.get_object_name(), exc_info=True)
+        
+        logging.debug("Fetching info of %s mbeans with %s workers", len(mbeans), self.metadata_workers)
+        pool = ThreadPool(min(self.metadata_workers, len(mbeans)))
+        try:
+            pool.map(fetch, mbeans)
+        finally:
+            pool.close()
+            pool.join()
+        
+    def __new_root_directory(self):
+        root_dir = fs.root_directory()
+        
+        connection_info_file = fs.static_file("connection_info")
+        connection_info_file.set_contents("%s:%s" % (self.mbean_server.server, self.mbean_server.port))       
+        root_dir.add_child(connection_info_file)
+        
+        connection_info_file = fs.file_rescan_interval("rescan", self)        
+        root_dir.add_child(connection_info_file)
+        
+        root_dir.add_child(fs.query_directory(".query", self))
+        for child in self.root_children:
+            root_dir.add_child(child)
+        return root_dir
+    
+    def add_root_child(self, child):
+        """ Add child to the root of the tree, and of any tree built later """
+        self.root_children.append(child)
+        if self.root_dir:
+            self.root_dir.add_child(child)
+    
+    def __add_mbean_directory(self, root_dir, mbean):
+        """ Add a directory for mbean below root_dir. Any missing parent directories
+            are built first and attached last, so requests never see a partial branch """
+        mbean_name = mbean.get_name_array()
+        mbean_dir = fs.mbean_directory(mbean_name[-1], mbean, self)
+        
+        # Find the deepest existing parent
+        parent = root_dir
+        depth = 0
+        # Get all but the last elements of the mbean name
+        for mbean_name_element in mbean_name[:-1]:
+            child = parent.children.get(mbean_name_element)
+            if not child:
+                break
+            parent = child
+            depth += 1
+            
+        if depth == len(mbean_name) - 1:
+            # Keep the directories of other mbeans already below this path, whether they are
+            # in a plain directory or in the directory of an mbean being replaced
+            existing = parent.children.get(mbean_name[-1])
+            if isinstance(existing, fs.directory):
+                for (name, child) in self.__nested_mbean_children(existing):
+                    mbean_dir.add_child(child)
+            
+        # Build the missing parents from the bottom up
+        branch = mbean_dir
+        for mbean_name_element in reversed(mbean_name[depth:-1]):
+            new_parent = fs.directory(mbean_name_element)
+            new_parent.add_child(branch)
+            branch = new_parent
+        parent.add_child(branch)
+        parent.touch()
+        return mbean_dir
+    
+    def __nested_mbean_children(self, mbean_dir):
+        """ Returns (name, child) for each child of a directory which leads to the directories of
+            other mbeans, e.g. type=X,name=Y,topic=Z below type=X,name=Y, rather than belonging
+            to the mbean itself """
+        return [(name, child) for (name, child) in mbean_dir.children.items()
+                if isinstance(child, fs.mbean_directory) or type(child) is fs.directory]
+    
+    def __remove_mbean_directory(self, root_dir, mbean_dir):
+        """ Remove mbean_dir and any parent directories which are left empty. If other mbeans
+            are below it, it is replaced by a plain directory holding them """
+        mbean_name = mbean_dir.mbean.get_name_array()
+        
+        parents = []
+        parent = root_dir
+        for mbean_name_element in mbean_name[:-1]:
+            parents.append(parent)
+            parent = parent.children.get(mbean_name_element)
+            if not parent:
+                return
+        
+        if parent.children.get(mbean_name[-1]) is not mbean_dir:
+            # Replaced by another mbean with the same path
+            return
+        nested_children = self.__nested_mbean_children(mbean_dir)
+        if nested_children:
+            plain_dir = fs.directory(mbean_name[-1])
+            for (name, child) in nested_children:
+                plain_dir.add_child(child)
+            parent.add_child(plain_dir)
+            parent.touch()
+            return
+        parent.remove_child(mbean_name[-1])
+        
+        # Prune parents, deepest first, which have nothing left but "." and ".."
+        for (grand_parent, mbean_name_element) in reversed(zip(parents, mbean_name[:-1])):
+            child = grand_parent.children[mbean_name_element]
+            if isinstance(child, fs.mbean_directory) or not child.is_empty():
+                break
+            grand_parent.remove_child(mbean_name_element)
+        
+    def get_root(self):
+        """ Return the current tree, building it first if there is none yet """
+        root_dir = self.root_dir
+        if not root_dir:
+            with self.build_lock:
+                if not self.root_dir:
+                    self.__build_tree()
+            root_dir = self.root_dir
+        return root_dir
+    
+    def get_name(self):
+        return "%s:%s" % (self.mbean_server.server, self.mbean_server.port)
+    
+    def count_nodes(self):
+        """ Returns the number of files and directories in the tree, not counting the contents
+            of mbean and attribute directories which haven't been used yet """
+        count = 0
+        directories = [self.root_dir] if self.root_dir else []
+        while directories:
+            directory = directories.pop()
+            for (name, child) in directory.children.items():
+                if name in (".", ".."):
+                    continue
+                count += 1
+                if isinstance(child, fs.directory):
+                    directories.append(child)
+        return count
+        
+    def get_mbeans(self):
+        """ Returns the mbeans in the tree """
+        return [mbean_dir.mbean for mbean_dir in self.mbean_dirs.values()]
+    
+    def get_attribute_value(self, attribute):
+        """ Get the raw value of an mbean attribute, from the value cache if it is fresh enough """
+        return self.value_cache.get(attribute.mbean.get_object_name(), attribute.get_name(), attribute.get_raw_value)
+    
+    def get_attribute_item_value(self, attribute, path):
+        """ Get the raw value of the item at path within a composite or tabular attribute. 
+            It is taken from the whole value if that is cached, otherwise only the item is read """
+        object_name = attribute.mbean.get_object_name()
+        (found, value) = self.value_cache.lookup(object_name, attribute.get_name())
+        if found:
+            try:
+                for element in path:
+                    value = value[element]
+                return value
+            except (KeyError, IndexError, TypeError):
+                # The structure has changed since it was discovered
+                pass
+        return self.value_cache.get(object_name, attribute.get_name(), lambda: attribute.get_raw_item_value(path), path)
+    
+    def query_attribute_values(self, pattern, attribute_name):
+        """ Read attribute_name of every mbean matching the object name pattern, with one request
+            through the value cache. Returns a dict of object name to raw value """
+        def fetch():
+            values = self.mbean_server.read_attribute_pattern(pattern, attribute_name)
+            for (object_name, value) in values.items():
+                self.value_cache.put(object_name, attribute_name, value)
+            return values
+        
+        if jolokiaparser.is_object_name_pattern(pattern):
+            return self.value_cache.get(pattern, attribute_name, fetch)
+        # A pattern without wildcards names a single mbean, whose value is cached under its own name
+        return {pattern: self.value_cache.get(pattern, attribute_name, lambda: fetch()[pattern])}
+
+    def matches_mbeans(self, pattern):
+        """ True if the object name pattern matches any mbean in the tree """
+        for object_name in self.mbean_dirs.keys():
+            if jolokiaparser.object_name_matches(pattern, object_name):
+                return True
+        return False
 
+    def prefetch_attribute_values(self, mbean):
+        """ Read, with a single request, every readable attribute of mbean which can be cached
+            but has no fresh value in the cache, and cache the values. Attributes which could not
+            be read are left to be read on their own. Returns the seconds until the values read
+            expire, before which prefetching again is pointless, even if this prefetch failed """
+        object_name = mbean.get_object_name()
+        attribute_names = [attribute.get_name() for attribute in mbean.get_attributes() if attribute.read]
+        missing_names = [name for name in attribute_names if self.value_cache.needs_fetch(object_name, name)]
+        if not missing_names:
+            return 0
+        ttl = min(self.value_cache.policy.get_ttl(object_name, name) for name in missing_names)
+        
+        try:
+            if len(missing_names) == len(attribute_names):
+                # Read all attributes rather than sending the names of all of them
+                values = mbean.get_attribute_values()
+            else:
+                values = mbean.get_attribute_values(missing_names)
+        except Exception:
+            # Reads of the individual attributes will report the error
+            logging.debug("Prefetching attributes of %s failed", object_name, exc_info=True)
+            return ttl
+            
+        for (name, value) in values.items():
+            if not jolokiaparser.is_error_value(value):
+                self.value_cache.put(object_name, name, value)
+        return ttl
             
-        cls.last_build_time = datetime.now()
+    def read_all_attribute_values(self, mbean):
+        """ Read all attributes of mbean with one request, bypassing but refreshing the value cache.
+            Attributes which could not be read have their error as their value """
+        object_name = mbean.get_object_name()
+        values = mbean.get_attribute_values()
+        for (name, value) in values.items():
+            if not jolokiaparser.is_error_value(value):
+                self.value_cache.put(object_name, name, value)
+        return values
     
-    @classmethod
-    def __get_depth(cls, path):
+    def set_attribute_value(self, attribute, value):
+        try:
+            return attribute.set_attribute(value)
+        finally:
+            self.value_cache.invalidate(attribute.mbean.get_object_name(), attribute.get_name())
+    
+    def __get_depth(self, path):
         """
         Return the depth of a given path, zero-based from mount point ('/')
         """
@@ -102,38 +565,78 @@ class jmx_tree_manager:
         else:
             return path.count('/')
 
-    @classmethod
-    def get_path(cls, path):
-        logging.debug("Last build time: %s" % cls.last_build_time)
-        logging.debug("Now: %s" % datetime.now())
-        logging.debug("Rescan interval: %s" % cls.rescan_interval)
-        next_build_time = 0
-        if cls.last_build_time:
-            next_build_time = cls.last_build_time + cls.rescan_timedelta
-            logging.debug("Next build time: %s" % next_build_time)
-        # If now > last_time+rescan_interval or root_dir is empty
-        logging.debug("Root dir: %s" % cls.root_dir)
-        if not cls.root_dir:
-            cls.build_tree()
-        elif datetime.now() >= next_build_time:
-            # Rebuild tree
-            logging.debug("Rebuilding tree")
-            cls.build_tree()
+    def get_path(self, path):
+        root_dir = self.get_root()
         
         path_list = path.split("/")[1:]
-        logging.debug("Path: %s" % path)
-        logging.debug("Path List: %s" % path_list)
+        logging.debug("Path List: %s", path_list)
         
         dir = None
         
-        if cls.__get_depth(path) == 0:
+        if self.__get_depth(path) == 0:
             logging.debug("Root dir")
-            dir = cls.root_dir
+            dir = root_dir
         else:
-            parent = cls.root_dir
+            parent = root_dir
             for path_element in path_list:
                 # navigate down fs objects
                 dir = parent.get_child(path_element)
+                if not dir:
+                    break
                 parent = dir
         
-        return dir
\ No newline at end of file
+        return dir
+    
+class jmx_mount_manager(object):
+    """ Routes paths to the tree managers of the mounted mbean servers. With a single 
+        server its tree is the root of the mount, otherwise the tree of each server 
+        is a top level directory named host:port """
+    
+    def __init__(self, tree_managers):
+        self.tree_managers = {}
+        self.single_tree_manager = None
+        self.root_dir = fs.root_directory()
+        stats_dir = fs.stats_directory(".stats", self)
+        
+        if len(tree_managers) == 1:
+            self.single_tree_manager = tree_managers[0]
+            self.single_tree_manager.add_root_child(stats_dir)
+        else:
+            for tree_manager in tree_managers:
+                name = tree_manager.get_name()
+                self.tree_managers[name] = tree_manager
+                self.root_dir.add_child(fs.directory(name))
+            self.root_dir.add_child(stats_dir)
+                
+    def get_tree_managers(self):
+        if self.single_tree_manager:
+            return [self.single_tree_manager]
+        return self.tree_managers.values()
+    
+    def start_refreshers(self):
+        """ Start the refresher of every server. Each builds its own tree, so servers are scanned concurrently """
+        for tree_manager in self.get_tree_managers():
+            tree_manager.start_refresher()
+            
+    def start_samplers(self):
+        for tree_manager in self.get_tree_managers():
+            tree_manager.start_sampler()
+                
+    def get_path(self, path):
+        if self.single_tree_manager:
+            return self.single_tree_manager.get_path(path)
+        
+        if path == "/":
+            return self.root_dir
+        
+        (name, sep, sub_path) = path[1:].partition("/")
+        tree_manager = self.tree_managers.get(name)
+        if not tree_manager:
+            # Entries of the mount's own root, e.g. .stats
+            node = self.root_dir
+            for path_element in path[1:].split("/"):
+                node = node.get_child(path_element)
+                if not node:
+                    break
+            return node
+        return tree_manager.get_path("/" + sub_path)